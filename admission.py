@@ -0,0 +1,89 @@
+from collections import deque
+from datetime import datetime
+import asyncio
+
+import utils
+
+
+class Ticket:
+    def __init__(self, guild_id, estimate):
+        self.guild_id = guild_id
+        self.estimate = estimate
+        self.admitted = None
+        self._event = None
+
+    @utils.loop_bound
+    def event(self):
+        return asyncio.Event()
+
+    async def wait(self, timeout):
+        """
+        Waits until the ticket is admitted, returns False if the timeout is reached first
+        """
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        return self.admitted is not None
+
+
+class LoaderAdmission:
+    """
+    Limits the number of loaders that run at the same time on this worker
+
+    Loaders that exceed the limit are queued in FIFO order. The estimated start is calculated from the plan
+    estimates of the running and queued loaders.
+    """
+    def __init__(self, max_loaders=3):
+        self.max_loaders = max_loaders
+        self.running = []
+        self.queue = deque()
+
+    def enqueue(self, guild_id, estimate):
+        ticket = Ticket(guild_id, estimate)
+        self.queue.append(ticket)
+        self._admit()
+        return ticket
+
+    def release(self, ticket):
+        if ticket in self.running:
+            self.running.remove(ticket)
+
+        elif ticket in self.queue:
+            self.queue.remove(ticket)
+
+        self._admit()
+
+    def _admit(self):
+        while self.queue and len(self.running) < self.max_loaders:
+            ticket = self.queue.popleft()
+            ticket.admitted = datetime.utcnow()
+            ticket.event.set()
+            self.running.append(ticket)
+
+    def position(self, ticket):
+        return self.queue.index(ticket) + 1
+
+    def estimated_start(self, ticket):
+        now = datetime.utcnow()
+        # The times when the slots will be free again
+        slots = sorted(max(t.admitted + t.estimate, now) for t in self.running)
+        slots.extend([now] * (self.max_loaders - len(slots)))
+        for queued in self.queue:
+            slots.sort()
+            start = slots.pop(0)
+            if queued is ticket:
+                return start
+
+            slots.append(start + queued.estimate)
+
+        return now
+
+    def metrics(self):
+        return {
+            "running": len(self.running),
+            "queued": len(self.queue),
+            "max_loaders": self.max_loaders
+        }
+
@@ -0,0 +1,170 @@
+import asyncio
+import traceback
+import pymongo
+from datetime import datetime, timedelta
+
+import utils
+
+BUCKET_PREFIX = "audit_logs_"
+RETENTION = timedelta(days=365)
+
+
+def bucket_name(dt: datetime):
+    return f"{BUCKET_PREFIX}{dt.year}_{dt.month:02d}"
+
+
+def bucket_start(name):
+    year, month = name[len(BUCKET_PREFIX):].split("_")
+    return datetime(int(year), int(month), 1)
+
+
+def bucket_end(name):
+    start = bucket_start(name)
+    if start.month == 12:
+        return datetime(start.year + 1, 1, 1)
+
+    return datetime(start.year, start.month + 1, 1)
+
+
+def day_start(dt: datetime):
+    return datetime(dt.year, dt.month, dt.day)
+
+
+def bucket_names(now=None):
+    """
+    Returns the names of all buckets that are within the retention period, starting with the newest one
+    """
+    now = now or datetime.utcnow()
+    limit = now - RETENTION
+    year, month = now.year, now.month
+    result = []
+    while True:
+        name = bucket_name(datetime(year, month, 1))
+        if bucket_end(name) <= limit:
+            return result
+
+        result.append(name)
+        year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+
+
+async def guild_stats(db, guild_id, days=30):
+    """
+    Sums up the daily rollups of a guild, this never touches the raw audit logs
+    """
+    since = day_start(datetime.utcnow()) - timedelta(days=days - 1)
+    totals = {}
+    rollups = db.audit_log_stats.find({"guild": guild_id, "day": {"$gte": since}})
+    async for rollup in rollups:
+        for type, count in rollup["counts"].items():
+            totals[int(type)] = totals.get(int(type), 0) + count
+
+    return totals
+
+
+class AuditLogWriter:
+    """
+    Buffers audit logs in memory and writes them to the database in batches from a background task
+    """
+    def __init__(self, db, max_size=10000, batch_size=100, interval=1):
+        self.db = db
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self._queue = None
+        self._task = None
+        self._indexed = set()
+
+    @utils.loop_bound
+    def queue(self):
+        return asyncio.Queue(maxsize=self.max_size)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def put(self, entry):
+        self.start()
+        # This only blocks if the queue is full, so commands slow down instead of logs getting dropped
+        await self.queue.put(entry)
+
+    async def _next_batch(self):
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _ensure_indexes(self, name):
+        if name in self._indexed:
+            return
+
+        collection = self.db[name]
+        await collection.create_index([("guilds", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)])
+        await collection.create_index([("user", pymongo.ASCENDING)])
+        self._indexed.add(name)
+
+    async def _write(self, batch):
+        buckets = {}
+        for entry in batch:
+            buckets.setdefault(bucket_name(entry["timestamp"]), []).append(entry)
+
+        for name, entries in buckets.items():
+            try:
+                await self._ensure_indexes(name)
+                await self.db[name].insert_many(entries, ordered=False)
+            except Exception:
+                traceback.print_exc()
+
+    async def _update_stats(self, batch):
+        counts = {}
+        for entry in batch:
+            day = day_start(entry["timestamp"])
+            for guild_id in entry["guilds"]:
+                key = (guild_id, day)
+                counts.setdefault(key, {})
+                counts[key][entry["type"]] = counts[key].get(entry["type"], 0) + 1
+
+        await self.db.audit_log_stats.bulk_write([
+            pymongo.UpdateOne(
+                {"guild": guild_id, "day": day},
+                {"$inc": {f"counts.{type}": count for type, count in types.items()}},
+                upsert=True
+            )
+            for (guild_id, day), types in counts.items()
+        ], ordered=False)
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write(batch)
+                try:
+                    await self._update_stats(batch)
+                except Exception:
+                    # The logs themselves are already written
+                    traceback.print_exc()
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def close(self, timeout=10):
+        if self._queue is None:
+            return
+
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        if self._task is not None:
+            self._task.cancel()
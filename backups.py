@@ -1,7 +1,59 @@
 import traceback
+import functools
 import xenon_worker as wkr
 import asyncio
 import msgpack
+import bson
+from datetime import timedelta, timezone
+
+import utils
+import columnar
+import quotas
+import traffic
+
+BAN_PAGE_SIZE = 1000
+
+# The route class of each operation kind, they share one concurrency controller
+ROUTE_CLASSES = {
+    "edit_guild": "guild",
+    "edit_settings": "guild",
+    "delete_role": "roles",
+    "edit_role": "roles",
+    "create_role": "roles",
+    "delete_channel": "channels",
+    "create_channel": "channels",
+    "ban": "bans",
+    # Only waits for the copy source, there are no requests involved
+    "capture": None
+}
+# These operations don't depend on each other and can run concurrently,
+# roles and channels are created in order to keep their positions
+CONCURRENT_KINDS = ("delete_channel", "ban")
+# The number of concurrent operations that run at once, the traffic control limits the requests further
+CONCURRENT_WORKERS = 16
+
+RETRY_ATTEMPTS = 3
+# Seconds before the first retry, doubled on every attempt
+RETRY_BACKOFF = 5
+
+# Leaves some room for the fields around the backup data, the hard limit is 16 MB
+MAX_BACKUP_SIZE = 15 * 1024 * 1024
+
+# The sections that are added by the saver instead of being part of the guild snapshot
+SAVED_SECTIONS = ("roles", "members", "bans")
+
+# The options of a load if the user doesn't overwrite them
+LOAD_DEFAULTS = {
+    "settings": True,
+    "roles": True,
+    "delete_roles": True,
+    "channels": True,
+    "delete_channels": True,
+    "bans": False
+}
+
+# The order in which sections are dropped when a backup exceeds the size limit
+TRIM_ORDER = ("members", "bans")
 
 
 class Options:
@@ -29,221 +81,738 @@ class Options:
 
 
 class BackupSaver:
-    def __init__(self, client, guild):
+    def __init__(self, client, guild, max_size=MAX_BACKUP_SIZE, trim_order=TRIM_ORDER):
         self.client = client
         self.guild = guild
-        self.data = guild.to_dict()
+        self.data = utils.normalize_guild_ids(guild.to_dict())
+
+        self.max_size = max_size
+        self.trim_order = trim_order
+        # The encoded size of each section in bytes
+        self.sizes = {}
+        self.trimmed = []
+        self._captured = {}
+
+        for key, value in self.data.items():
+            if key not in SAVED_SECTIONS:
+                self._account(key, value)
+
+    @property
+    def size(self):
+        # Document header and terminator
+        return 5 + sum(self.sizes.values())
+
+    def _account(self, key, value):
+        # Without the header and terminator of the wrapping document
+        self.sizes[key] = len(bson.encode({key: value})) - 5
+
+    def _captured_event(self, key):
+        event = self._captured.get(key)
+        if event is None:
+            event = self._captured[key] = asyncio.Event()
+
+        return event
+
+    def _add_section(self, key, value):
+        self.data[key] = value
+        self._account(key, value)
+        self._captured_event(key).set()
+
+    async def section(self, key):
+        """
+        Waits until a section is captured, returns None if it couldn't be saved
+        """
+        if key in SAVED_SECTIONS:
+            await self._captured_event(key).wait()
+
+        return self.data.get(key)
+
+    def _trim(self):
+        trimmable = [key for key in self.trim_order if key in self.data]
+        if self.size - sum(self.sizes[key] for key in trimmable) > self.max_size:
+            # Dropping sections wouldn't help, the backup is too large either way
+            return
+
+        for key in trimmable:
+            if self.size <= self.max_size:
+                return
+
+            del self.data[key]
+            del self.sizes[key]
+            self.trimmed.append(key)
 
     async def _save_roles(self):
-        self.data["roles"] = [
-            r.to_dict()
+        self._add_section("roles", [
+            utils.normalize_role_ids(r.to_dict())
             for r in self.guild.roles
             if not r.managed
-        ]
+        ])
+
+    async def _fetch_ban_pages(self):
+        after = None
+        while True:
+            params = {"limit": BAN_PAGE_SIZE}
+            if after is not None:
+                params["after"] = after
+
+            page = await self.client.http.request(wkr.Route("GET", f"/guilds/{self.guild.id}/bans"), params=params)
+            if len(page) == 0:
+                return
+
+            yield page
+            if len(page) < BAN_PAGE_SIZE:
+                return
+
+            # Bans are sorted by the user id
+            after = page[-1]["user"]["id"]
+
+    async def _save_members(self):
+        self._add_section("members", columnar.encode_members(self.data.get("members", [])))
 
     async def _save_bans(self):
-        self.data["bans"] = [
-            {
-                "reason": ban["reason"],
-                "id": ban["user"]["id"]
-            }
-            for ban in await self.client.fetch_bans(self.guild)
-        ]
+        bans = columnar.BanColumns()
+        async for page in self._fetch_ban_pages():
+            # The full user objects of a page are dropped right away
+            for ban in page:
+                bans.add(ban["user"]["id"], ban["reason"])
+
+        self._add_section("bans", bans.encode())
 
     async def save(self, **options):
+        """
+        Saves all sections, sections can be skipped with e.g. bans=False
+        """
+        enabled = Options(**{key: True for key in SAVED_SECTIONS})
+        enabled.update(**options)
         savers = {
             "roles": self._save_roles,
+            "members": self._save_members,
             "bans": self._save_bans
         }
 
-        for _, saver in savers.items():
-            await saver()
+        try:
+            # The sections are independent of each other
+            await asyncio.gather(*[saver() for key, saver in savers.items() if enabled.get(key)])
+        finally:
+            # Don't leave anyone waiting for a section that failed
+            for key in SAVED_SECTIONS:
+                self._captured_event(key).set()
 
+        self._trim()
 
-class BackupLoader:
-    def __init__(self, client, guild, data, reason="Backup loaded"):
-        self.client = client
-        self.guild = guild
-        self.data = data
 
-        self.options = Options(
-            settings=True,
-            roles=True,
-            delete_roles=True,
-            channels=True,
-            delete_channels=True,
-            bans=False
-        )
-        self.id_translator = {data["id"]: guild.id}
-        self.reason = reason
+def operation_name(operation):
+    data = operation.data
+    if isinstance(data, dict):
+        return str(data.get("name") or data.get("id"))
 
-        self._member_cache = {}
+    return str(getattr(data, "name", None) or getattr(data, "id", operation.key))
 
-        self.status = None
 
-    async def _load_settings(self):
-        self.status = "loading settings"
+class MissingObject(Exception):
+    """
+    An object that was created by the loader but doesn't exist anymore
+    """
 
-        self.data.pop("guild_id", None)
-        await self.client.edit_guild(self.guild, **self.data, reason=self.reason)
 
-    async def _delete_roles(self):
-        self.status = "deleting roles"
+class Operation:
+    def __init__(self, key, kind, status, data=None):
+        self.key = key
+        self.kind = kind
+        self.status = status
+        self.data = data
 
-        existing = [
-            r for r in self.guild.roles
-            if not r.managed and not r.is_default()
-        ]
+        self.attempts = 0
+        self.error = None
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    @property
+    def retryable(self):
+        # Missing permissions and unknown objects won't go away by retrying
+        return self.failed and not isinstance(self.error, (wkr.Forbidden, wkr.NotFound))
+
+    def __repr__(self):
+        return f"<Operation key={self.key!r} kind={self.kind!r}>"
+
+
+class LoadPlan:
+    """
+    The operations of a load in the order they are executed
+
+    The order is the only contract between operations: an operation only relies on earlier ones, e.g. channels
+    are created after all roles exist. Only operations of CONCURRENT_KINDS in a row run concurrently.
+    """
+    # Rough number of seconds per operation with the usual rate limits of the routes
+    durations = {
+        "edit_guild": 1,
+        "edit_settings": 1,
+        "delete_role": 1,
+        "edit_role": 1,
+        "create_role": 1,
+        "delete_channel": 0.5,
+        "create_channel": 1,
+        "ban": 0.5
+    }
+
+    def __init__(self):
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def add(self, key, kind, status, data=None):
+        operation = Operation(key, kind, status, data=data)
+        self.operations.append(operation)
+        return operation
+
+    def keys(self, kind):
+        return [op.key for op in self.operations if op.kind == kind]
+
+    def insert_after(self, operation, operations):
+        index = self.operations.index(operation)
+        self.operations[index + 1:index + 1] = operations
+
+    def remove(self, keys):
+        keys = set(keys)
+        self.operations = [op for op in self.operations if op.key not in keys]
+
+    def counts(self):
+        counts = {}
+        for operation in self.operations:
+            counts[operation.kind] = counts.get(operation.kind, 0) + 1
+
+        return counts
+
+    def estimate(self):
+        return timedelta(seconds=sum(
+            self.durations.get(kind, 1) * count
+            for kind, count in self.counts().items()
+        ))
+
+
+async def prepare_loader(client, guild_coro, data, options, reason):
+    """
+    Fetches the target guild and compiles the load plan, this runs while the user confirms the load
+
+    Returns the loader and the number of roles that were left out because of the role creation limit.
+    """
+    guild = await guild_coro
+    loader = BackupLoader(client, guild, data, reason=reason)
+    loader.compile(**options)
+    trimmed_roles = await loader.apply_role_quota()
+    return loader, trimmed_roles
+
+
+async def prepare_copy(client, saver, guild_coro, options, reason):
+    """
+    Starts saving the source guild and compiles the load plan for the target guild as soon as the roles are captured
+
+    Sections that are captured later (bans) are loaded as soon as they are available.
+    """
+    load_options = Options(**LOAD_DEFAULTS)
+    load_options.update(**options)
+    # Members are never loaded, bans only if they were requested
+    capture = client.schedule(saver.save(members=False, bans=load_options.bans))
+    try:
+        await saver.section("roles")
+        # Sections that are captured later are handed to the loader by capture operations
+        data = {key: value for key, value in saver.data.items() if key not in ("members", "bans")}
+        loader = BackupLoader(client, await guild_coro, data, reason=reason)
+        loader.capture = capture
+        loader.sections["bans"] = functools.partial(saver.section, "bans")
+        loader.compile(**options)
+        trimmed_roles = await loader.apply_role_quota()
+    except BaseException:
+        capture.cancel()
+        raise
+
+    return loader, trimmed_roles
+
+
+async def _wait_for_confirmation(ctx, message, timeout=60):
+    reactions = ("✅", "❌")
+    for reaction in reactions:
+        await ctx.client.add_reaction(message, reaction)
+
+    try:
+        data, = await ctx.client.wait_for(
+            "message_reaction_add",
+            ctx.shard_id,
+            check=lambda d: d["message_id"] == message.id and
+                            d["user_id"] == ctx.author.id and
+                            d["emoji"]["name"] in reactions,
+            timeout=timeout
+        )
+    except asyncio.TimeoutError:
+        return False
+
+    return data["emoji"]["name"] == "✅"
+
+
+async def confirm_load(ctx, prepare, warning_text):
+    """
+    Sends the load prompt and prepares the loader in the background while the user confirms
+
+    Errors of the preparation replace the prompt right away.
+    Returns the prepared loader or None if the user didn't confirm, the speculative work is discarded in that case.
+    """
+    prefetch = ctx.bot.schedule(prepare)
+    warning_msg = await ctx.f_send(warning_text + "\n\n*Calculating the required operations ...*",
+                                   f=ctx.f.WARNING)
+    confirmation = ctx.bot.schedule(_wait_for_confirmation(ctx, warning_msg))
+    try:
+        await asyncio.wait([prefetch, confirmation], return_when=asyncio.FIRST_COMPLETED)
+        if prefetch.done():
+            if prefetch.exception() is not None:
+                confirmation.cancel()
+                raise prefetch.exception()
+
+            loader, trimmed_roles = prefetch.result()
+            text = warning_text + "\n\n" + plan_summary(loader.plan, trimmed_roles)
+            await ctx.client.edit_message(warning_msg, embed=ctx.f.format(text, f=ctx.f.WARNING)["embed"])
+
+        confirmed = await confirmation
+    except BaseException:
+        prefetch.cancel()
+        confirmation.cancel()
+        raise
+
+    finally:
+        await ctx.client.delete_message(warning_msg)
+
+    if not confirmed:
+        prefetch.cancel()
+        if prefetch.done() and not prefetch.cancelled() and prefetch.exception() is None:
+            loader, _ = prefetch.result()
+            loader.discard()
+
+        return None
+
+    loader, _ = await prefetch
+    try:
+        # The user had time to change the guild, e.g. to move the managed role
+        await loader.refresh()
+    except BaseException:
+        loader.discard()
+        raise
+
+    return loader
+
+
+async def run_load(ctx, loader, event, audit_log_type, guild_ids=None, extra=None):
+    """
+    Runs a confirmed loader, reports missing objects and publishes the start and end of the load
+    """
+    await ctx.bot.redis.publish("loaders:start", msgpack.packb(event))
+    try:
+        await loader.load()
+
+        await ctx.bot.translators.merge(
+            loader.data["id"],
+            ctx.guild_id,
+            loader.id_translator,
+            loader_id=ctx.author.id
+        )
 
-        for role in sorted(existing, key=lambda r: r.position):
+        report = loader.report()
+        if report:
             try:
-                await self.client.delete_role(role, reason=self.reason)
-            except wkr.Forbidden:
-                break
-
+                await ctx.f_send(f"Some parts **couldn't be loaded**: {report_summary(report)}", f=ctx.f.WARNING)
             except wkr.DiscordException:
+                # The channel was probably replaced by the load
                 pass
 
-    async def _load_roles(self):
-        self.status = "loading roles"
-        roles = list(sorted(self.data["roles"], key=lambda r: r["position"], reverse=True))
-        for role in roles:
-            role.pop("guild_id", None)
-            role.pop("position", None)
-            role.pop("managed", None)
-
-            # Default role (@everyone)
-            # role["id"] == 0 is an edge case of cross-loaded templates
-            if role["id"] == self.data["id"] or role["id"] == 0:
-                to_edit = self.guild.default_role
-                if to_edit is not None:
-                    try:
-                        await self.client.edit_role(to_edit, **role, reason=self.reason)
-                        self.id_translator[role["id"]] = to_edit.id
-
-                    except wkr.DiscordException:
-                        traceback.print_exc()
+    finally:
+        await ctx.bot.redis.publish("loaders:done", msgpack.packb({**event, "missing": loader.report()}))
+        await ctx.bot.create_audit_log(audit_log_type, guild_ids or [ctx.guild_id], ctx.author.id, extra=extra)
 
-                continue
 
-            try:
-                new = await asyncio.wait_for(
-                    self.client.create_role(self.guild, **role, reason=self.reason),
-                    timeout=15
-                )
-            except asyncio.TimeoutError:
-                raise self.client.f.ERROR("Seems like you **hit** the `250 per 48 hours` **role creation limit** of "
-                                          "discord.\nYou have to **wait for 48 hours** until you can load another "
-                                          "backup or template.\n\n"
-                                          "*This is a discord limitation and there is no way around it.*")
+def plan_summary(plan, trimmed_roles):
+    summary = f"This will take **{len(plan)} operations** and about " \
+              f"`{utils.timedelta_to_string(plan.estimate())}`."
+    if trimmed_roles:
+        summary += f"\n**{trimmed_roles} roles** will be **left out** because of the role creation limit."
 
-            except wkr.DiscordException:
-                traceback.print_exc()
-                continue
+    return summary
 
-            self.id_translator[role["id"]] = new.id
 
-    async def _delete_channels(self):
-        self.status = "deleting channels"
+REPORT_NAMES = {
+    "edit_guild": "server name",
+    "edit_settings": "settings",
+    "delete_role": "role deletions",
+    "edit_role": "default role",
+    "create_role": "roles",
+    "delete_channel": "channel deletions",
+    "create_channel": "channels",
+    "ban": "bans"
+}
+
+
+# Roles and channels are listed by name, everything else is only counted
+NAMED_REPORT_KINDS = ("create_role", "create_channel")
+REPORT_MAX_NAMES = 10
 
-        for channel in self.guild.channels:
-            try:
-                await self.client.delete_channel(channel, reason=self.reason)
-            except wkr.DiscordException:
-                traceback.print_exc()
 
-    async def _load_channels(self):
-        self.status = "loading channels"
+def report_summary(report):
+    parts = []
+    for kind, names in report.items():
+        part = f"**{len(names)}** {REPORT_NAMES.get(kind, kind)}"
+        if kind in NAMED_REPORT_KINDS:
+            part += " (" + ", ".join(f"`{name}`" for name in names[:REPORT_MAX_NAMES])
+            if len(names) > REPORT_MAX_NAMES:
+                part += f" and {len(names) - REPORT_MAX_NAMES} more"
 
-        def _tune_channel(channel):
-            channel.pop("guild_id", None)
+            part += ")"
 
-            # Bitrates over 96000 require special features or boosts
-            # (boost advantages change a lot, so we just ignore them)
-            if "bitrate" in channel.keys() and "VIP_REGIONS" not in self.guild.features:
-                channel["bitrate"] = min(channel["bitrate"], 96000)
+        parts.append(part)
 
-            # News and store channels require special features
-            if (channel["type"] == wkr.ChannelType.GUILD_NEWS and "NEWS" not in self.guild.features) or \
-                    (channel["type"] == wkr.ChannelType.GUILD_STORE and "COMMERCE" not in self.guild.features):
-                channel["type"] = 0
+    return ", ".join(parts)
 
-            channel["type"] = 0 if channel["type"] > 4 else channel["type"]
 
-            if "parent_id" in channel.keys():
-                if channel["parent_id"] in self.id_translator:
-                    channel["parent_id"] = self.id_translator[channel["parent_id"]]
+class BackupLoader:
+    def __init__(self, client, guild, data, reason="Backup loaded"):
+        self.client = client
+        self.guild = guild
+        self.data = columnar.decode(data)
+        # The existing roles and channels that are deleted, these can be refreshed before the load starts
+        self.roles = guild.roles
+        self.channels = guild.channels
+
+        self.options = Options(**LOAD_DEFAULTS)
+        self.id_translator = {data["id"]: guild.id}
+        self.reason = reason
+        self.plan = None
+        # Sections that are still being captured, used when copying guilds directly
+        self.sections = {}
+        self.capture = None
+
+        self._member_cache = {}
+        self._roles_forbidden = False
+
+        self.status = None
+
+    def compile(self, **options):
+        """
+        Turns the backup, the current state of the guild and the options into a plan of operations
+        """
+        self.options.update(**options)
+        plan = LoadPlan()
+        plan.add("start", "edit_guild", "starting", {"name": "Loading ..."})
+
+        if self.options.delete_roles:
+            existing = [
+                r for r in self.roles
+                if not r.managed and not r.is_default()
+            ]
+            for role in sorted(existing, key=lambda r: r.position):
+                plan.add(f"delete_role:{role.id}", "delete_role", "deleting roles", role)
+
+        if self.options.roles:
+            for role in sorted(self.data["roles"], key=lambda r: r["position"], reverse=True):
+                # Default role (@everyone)
+                # role["id"] == 0 is an edge case of cross-loaded templates
+                if role["id"] == self.data["id"] or role["id"] == 0:
+                    plan.add(f"edit_role:{role['id']}", "edit_role", "loading roles", role)
 
                 else:
-                    del channel["parent_id"]
+                    # Deleting first keeps us below the role limit
+                    plan.add(f"create_role:{role['id']}", "create_role", "loading roles", role)
+
+        if self.options.delete_channels:
+            for channel in self.channels:
+                plan.add(f"delete_channel:{channel.id}", "delete_channel", "deleting channels", channel)
+
+        if self.options.channels:
+            # Overwrites can only be translated after all roles exist, parents are created before their children
+            no_parent = sorted(
+                filter(lambda c: c.get("parent_id") is None, self.data["channels"]),
+                key=lambda c: c.get("position")
+            )
+            has_parent = sorted(
+                filter(lambda c: c.get("parent_id") is not None, self.data["channels"]),
+                key=lambda c: c["position"]
+            )
+            for channel in no_parent + has_parent:
+                plan.add(f"create_channel:{channel['id']}", "create_channel", "loading channels", channel)
+
+        if self.options.bans:
+            if "bans" in self.sections:
+                plan.add("capture:bans", "capture", "capturing bans", "bans")
+
+            for ban in self.data.get("bans", []):
+                plan.add(f"ban:{ban['id']}", "ban", "loading bans", ban)
+
+        if self.options.settings:
+            plan.add("settings", "edit_settings", "loading settings")
+
+        plan.add("finish", "edit_guild", "finishing", {"name": self.data["name"]})
+        self.plan = plan
+        return plan
+
+    async def apply_role_quota(self):
+        """
+        Checks the planned role creations against the role creation ledger of the guild
+
+        Raises an error before anything is deleted if no roles can be created at all,
+        otherwise the lowest roles are left out. Returns the number of roles that were left out.
+        """
+        creates = self.plan.keys("create_role")
+        if not creates:
+            return 0
+
+        remaining = await quotas.remaining_role_creates(self.client.redis, self.guild.id)
+        if remaining == 0:
+            raise self.client.f.ERROR("You **hit** the `250 per 48 hours` **role creation limit** of discord.\n"
+                                      "You have to **wait up to 48 hours** until you can load another "
+                                      "backup or template.\n\n"
+                                      "*This is a discord limitation and there is no way around it.*")
+
+        # Roles are planned from the highest to the lowest
+        trimmed = creates[remaining:]
+        self.plan.remove(trimmed)
+        return len(trimmed)
+
+    async def refresh(self):
+        """
+        Fetches the current roles and channels of the guild and plans the load again
+
+        Returns the number of roles that were left out because of the role creation limit.
+        """
+        self.roles = await self.client.fetch_roles(self.guild)
+        channels = await self.client.http.request(wkr.Route("GET", f"/guilds/{self.guild.id}/channels"))
+        self.channels = [wkr.Snowflake(channel["id"]) for channel in channels]
+        self.compile()
+        return await self.apply_role_quota()
+
+    def discard(self):
+        """
+        Stops capturing the copy source
+        """
+        if self.capture is not None:
+            self.capture.cancel()
+
+    async def _run_edit_guild(self, operation):
+        await self.client.edit_guild(self.guild, **operation.data)
+
+    async def _run_edit_settings(self, _):
+        self.data.pop("guild_id", None)
+        await self.client.edit_guild(self.guild, **self.data, reason=self.reason)
 
-            overwrites = channel.get("permission_overwrites", [])
-            new_overwrites = []
-            for overwrite in overwrites:
-                if overwrite["id"] in self.id_translator:
-                    overwrite["id"] = self.id_translator[overwrite["id"]]
-                    new_overwrites.append(overwrite)
+    async def _run_delete_role(self, operation):
+        if self._roles_forbidden:
+            return
+
+        try:
+            await self.client.delete_role(operation.data, reason=self.reason)
+        except wkr.Forbidden:
+            # All remaining roles are above the bots role
+            self._roles_forbidden = True
+
+        except wkr.DiscordException:
+            pass
+
+    def _tune_role(self, role):
+        role = dict(role)
+        role.pop("guild_id", None)
+        role.pop("position", None)
+        role.pop("managed", None)
+        return role
+
+    async def _run_edit_role(self, operation):
+        role = self._tune_role(operation.data)
+        to_edit = self.guild.default_role
+        if to_edit is not None:
+            await self.client.edit_role(to_edit, **role, reason=self.reason)
+            self.id_translator[operation.data["id"]] = to_edit.id
+
+    async def _run_create_role(self, operation):
+        role = self._tune_role(operation.data)
+        try:
+            new = await asyncio.wait_for(
+                self.client.create_role(self.guild, **role, reason=self.reason),
+                timeout=15
+            )
+        except asyncio.TimeoutError:
+            await quotas.exhaust_role_creates(self.client.redis, self.guild.id)
+            raise self.client.f.ERROR("Seems like you **hit** the `250 per 48 hours` **role creation limit** of "
+                                      "discord.\nYou have to **wait for 48 hours** until you can load another "
+                                      "backup or template.\n\n"
+                                      "*This is a discord limitation and there is no way around it.*")
+
+        self.id_translator[operation.data["id"]] = new.id
+        await quotas.record_role_creates(self.client.redis, self.guild.id, [new.id])
+
+    async def _run_delete_channel(self, operation):
+        try:
+            await self.client.delete_channel(operation.data, reason=self.reason)
+        except wkr.NotFound:
+            # Already deleted
+            pass
+
+    def _tune_channel(self, channel):
+        # Operations might be retried, so the planned data is left untouched
+        channel = dict(channel)
+        channel.pop("guild_id", None)
+
+        # Bitrates over 96000 require special features or boosts
+        # (boost advantages change a lot, so we just ignore them)
+        if "bitrate" in channel.keys() and "VIP_REGIONS" not in self.guild.features:
+            channel["bitrate"] = min(channel["bitrate"], 96000)
+
+        # News and store channels require special features
+        if (channel["type"] == wkr.ChannelType.GUILD_NEWS and "NEWS" not in self.guild.features) or \
+                (channel["type"] == wkr.ChannelType.GUILD_STORE and "COMMERCE" not in self.guild.features):
+            channel["type"] = 0
+
+        channel["type"] = 0 if channel["type"] > 4 else channel["type"]
+
+        if "parent_id" in channel.keys():
+            if channel["parent_id"] in self.id_translator:
+                channel["parent_id"] = self.id_translator[channel["parent_id"]]
 
-            channel["permission_overwrites"] = new_overwrites[:100]
+            else:
+                del channel["parent_id"]
+
+        overwrites = channel.get("permission_overwrites", [])
+        new_overwrites = []
+        for overwrite in overwrites:
+            if overwrite["id"] in self.id_translator:
+                new_overwrites.append({**overwrite, "id": self.id_translator[overwrite["id"]]})
+
+        channel["permission_overwrites"] = new_overwrites[:100]
+
+        return channel
+
+    async def _run_create_channel(self, operation):
+        channel = operation.data
+        new = await self.client.create_channel(self.guild, **self._tune_channel(channel), reason=self.reason)
+        self.id_translator[channel["id"]] = new.id
+
+    async def _run_ban(self, operation):
+        ban = operation.data
+        await self.client.ban_user(self.guild, wkr.Snowflake(ban["id"]), reason=ban["reason"])
+
+    async def _run_capture(self, operation):
+        section = await self.sections[operation.data]()
+        if section is None:
+            # The source couldn't be saved completely
+            return
+
+        bans = columnar.decode_bans(section) if columnar.is_encoded(section) else section
+        self.plan.insert_after(operation, [
+            Operation(f"ban:{ban['id']}", "ban", "loading bans", ban)
+            for ban in bans
+        ])
+
+    async def _run_operation(self, operation):
+        self.status = operation.status
+        runner = getattr(self, f"_run_{operation.kind}")
+        operation.attempts += 1
+        operation.error = None
+        try:
+            route_class = ROUTE_CLASSES[operation.kind]
+            if route_class is None:
+                await runner(operation)
 
-            return channel
+            else:
+                async with self.client.traffic.permit(route_class):
+                    await runner(operation)
+        except wkr.CommandError:
+            raise
+        except wkr.DiscordException as e:
+            traceback.print_exc()
+            operation.error = e
+
+    async def _verify(self):
+        """
+        Compares the created roles and channels with the current state of the guild
+        """
+        self.status = "verifying"
+        roles = await self.client.fetch_roles(self.guild)
+        channels = await self.client.http.request(wkr.Route("GET", f"/guilds/{self.guild.id}/channels"))
+        existing = {
+            "create_role": {utils.snowflake(r.id) for r in roles},
+            "create_channel": {utils.snowflake(c["id"]) for c in channels}
+        }
 
-        no_parent = sorted(
-            filter(lambda c: c.get("parent_id") is None, self.data["channels"]),
-            key=lambda c: c.get("position")
-        )
-        for channel in no_parent:
-            try:
-                new = await self.client.create_channel(self.guild, **_tune_channel(channel), reason=self.reason)
-                self.id_translator[channel["id"]] = new.id
-            except wkr.DiscordException:
-                traceback.print_exc()
+        for operation in self.plan:
+            if operation.failed or operation.kind not in existing:
+                continue
 
-        has_parent = sorted(
-            filter(lambda c: c.get("parent_id") is not None, self.data["channels"]),
-            key=lambda c: c["position"]
-        )
-        for channel in has_parent:
+            target_id = self.id_translator.get(operation.data["id"])
+            if target_id is None or utils.snowflake(target_id) not in existing[operation.kind]:
+                operation.error = MissingObject(operation.key)
+
+    async def _retry_failed(self):
+        # The last round is only verified, so the report contains everything that is actually missing
+        for attempt in range(RETRY_ATTEMPTS + 1):
             try:
-                new = await self.client.create_channel(self.guild, **_tune_channel(channel), reason=self.reason)
-                self.id_translator[channel["id"]] = new.id
+                await self._verify()
             except wkr.DiscordException:
                 traceback.print_exc()
 
-    async def _load_bans(self):
-        self.status = "loading bans"
+            retry = [op for op in self.plan if op.retryable]
+            if not retry or attempt == RETRY_ATTEMPTS:
+                return
 
-        for ban in self.data.get("bans", []):
-            try:
-                await self.client.ban_user(self.guild, wkr.Snowflake(ban["id"]), reason=ban["reason"])
-            except wkr.DiscordException:
-                pass
+            self.status = "retrying failed operations"
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+            await self._run_operations(retry)
 
-    async def _load(self, **options):
-        self.options.update(**options)
-        await self.client.edit_guild(self.guild, name="Loading ...")
-        loaders = (
-            ("delete_roles", self._delete_roles),
-            ("roles", self._load_roles),
-            ("delete_channels", self._delete_channels),
-            ("channels", self._load_channels),
-            ("bans", self._load_bans),
-            ("settings", self._load_settings)
-        )
+    def report(self):
+        """
+        Returns the names of the objects that are still missing after the load, by operation kind
+        """
+        missing = {}
+        for operation in self.plan:
+            if operation.failed:
+                missing.setdefault(operation.kind, []).append(operation_name(operation))
+
+        return missing
+
+    async def _run_concurrent(self, operations):
+        pending = iter(operations)
+
+        async def _worker():
+            for operation in pending:
+                await self._run_operation(operation)
+
+        await asyncio.gather(*[_worker() for _ in range(min(CONCURRENT_WORKERS, len(operations)))])
+
+    async def _run_operations(self, operations):
+        concurrent = []
+        for operation in operations:
+            if operation.kind in CONCURRENT_KINDS:
+                concurrent.append(operation)
+                continue
+
+            if concurrent:
+                await self._run_concurrent(concurrent)
+                concurrent = []
+
+            await self._run_operation(operation)
+
+        if concurrent:
+            await self._run_concurrent(concurrent)
 
-        for key, loader in loaders:
-            if key == "" or self.options.get(key):
-                try:
-                    await loader()
-                except wkr.CommandError:
-                    raise
-                except wkr.DiscordException:
-                    traceback.print_exc()
+    async def _load(self):
+        # Runs in its own task, so this doesn't affect the command
+        traffic.current_lane.set("bulk")
+        await self._run_operations(self.plan)
 
-        await self.client.edit_guild(self.guild, name=self.data["name"])
+        await self._retry_failed()
 
     async def load(self, **options):
         self.status = "starting"
+        if self.plan is None:
+            self.compile(**options)
+            await self.apply_role_quota()
 
         redis_key = f"loaders:{self.guild.id}"
         if await self.client.redis.exists(redis_key):
@@ -252,20 +821,46 @@ class BackupLoader:
                                       "You can't start more than one at the same time.\n"
                                       "You have to **wait until it's done**.")
 
-        task = self.client.schedule(self._load(**options))
-        last_status = None
-        while not task.done():
-            await self.client.redis.setex(redis_key, 10, self.status)
-            if last_status != self.status:
-                await self.client.redis.publish(
-                    "loaders:status",
-                    msgpack.packb({"id": self.guild.id, "status": self.status})
-                )
-
-            await asyncio.sleep(5)
-            if not await self.client.redis.exists(redis_key):
-                # The loading key got deleted, probably manual cancellation
-                task.cancel()
-                raise self.client.f.ERROR("The **loading process was cancelled**. Did you cancel it manually?")
+        ticket = self.client.loaders.enqueue(self.guild.id, self.plan.estimate())
+        try:
+            while ticket.admitted is None:
+                position = self.client.loaders.position(ticket)
+                start = self.client.loaders.estimated_start(ticket)
+                self.status = f"queued at position {position}"
+                await self.client.redis.setex(redis_key, 10, self.status)
+                await self.client.redis.publish("loaders:status", msgpack.packb({
+                    "id": self.guild.id,
+                    "status": self.status,
+                    "position": position,
+                    "eta": start.replace(tzinfo=timezone.utc).timestamp()
+                }))
+
+                if await ticket.wait(timeout=5):
+                    break
+
+                if not await self.client.redis.exists(redis_key):
+                    # The loading key got deleted, probably manual cancellation
+                    raise self.client.f.ERROR("The **loading process was cancelled**. Did you cancel it manually?")
+
+            task = self.client.schedule(self._load())
+            last_status = None
+            while not task.done():
+                await self.client.redis.setex(redis_key, 10, self.status)
+                if last_status != self.status:
+                    last_status = self.status
+                    await self.client.redis.publish(
+                        "loaders:status",
+                        msgpack.packb({"id": self.guild.id, "status": self.status})
+                    )
+
+                await asyncio.sleep(5)
+                if not await self.client.redis.exists(redis_key):
+                    # The loading key got deleted, probably manual cancellation
+                    task.cancel()
+                    raise self.client.f.ERROR("The **loading process was cancelled**. Did you cancel it manually?")
+
+        finally:
+            self.client.loaders.release(ticket)
+            self.discard()
 
         return task.result()
@@ -0,0 +1,47 @@
+"""
+Benchmarks the id generator and checks that worker processes with distinct worker ids never collide
+
+python bench_ids.py [processes] [ids per process]
+"""
+from multiprocessing import Pool
+import sys
+import time
+
+import utils
+
+
+def generate(worker_id, count):
+    generator = utils.IdGenerator(worker_id)
+    return [utils.base36_dumps(uid) for uid in generator.generate(count)]
+
+
+def benchmark(count):
+    generator = utils.IdGenerator(0)
+    start = time.perf_counter()
+    ids = generator.generate(count)
+    generated = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for uid in ids:
+        utils.base36_dumps(uid)
+
+    encoded = time.perf_counter() - start
+    print(f"generate: {count / generated:.0f} ids/s, base36: {count / encoded:.0f} ids/s")
+
+
+def collisions(processes, count):
+    with Pool(processes) as pool:
+        results = pool.starmap(generate, [(worker_id, count) for worker_id in range(processes)])
+
+    ids = [uid for result in results for uid in result]
+    duplicates = len(ids) - len(set(ids))
+    print(f"{len(ids)} ids from {processes} processes, {duplicates} duplicates")
+    return duplicates
+
+
+if __name__ == "__main__":
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    benchmark(count)
+    sys.exit(1 if collisions(processes, count) else 0)
@@ -3,17 +3,28 @@ import modules
 from datetime import datetime
 
 import checks
+from audit import AuditLogWriter
+from translators import IdTranslators
+from traffic import TrafficControl, LaneScheduler, trace
+from admission import LoaderAdmission
 
 
 class Xenon(wkr.RabbitBot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.db = self.mongo.xenon
+        self.audit_logs = AuditLogWriter(self.db)
+        self.translators = IdTranslators(self.db)
+        self.traffic = TrafficControl()
+        self.lanes = LaneScheduler()
+        self.http.request = self.lanes.wrap(self.http.request)
+        trace(self.http.session)
+        self.loaders = LoaderAdmission()
         for module in modules.to_load:
             self.add_module(module(self))
 
     async def create_audit_log(self, type, guild_ids, user_id, extra=None):
-        return await self.db.audit_logs.insert_one({
+        await self.audit_logs.put({
             "type": type.value,
             "timestamp": datetime.utcnow(),
             "guilds": guild_ids,
@@ -21,6 +32,10 @@ class Xenon(wkr.RabbitBot):
             "extra": extra or {}
         })
 
+    async def close(self):
+        await self.audit_logs.close()
+        await super().close()
+
     async def on_command_error(self, shard_id, cmd, ctx, e):
         if isinstance(e, checks.NotStaff):
             await ctx.f_send(
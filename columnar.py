@@ -0,0 +1,173 @@
+import sys
+from array import array
+
+
+def _pack(typecode, values):
+    packed = array(typecode, values)
+    # Always store little endian
+    if sys.byteorder == "big":
+        packed.byteswap()
+
+    return packed.tobytes()
+
+
+def _unpack(typecode, data):
+    unpacked = array(typecode)
+    unpacked.frombytes(data)
+    if sys.byteorder == "big":
+        unpacked.byteswap()
+
+    return unpacked.tolist()
+
+
+def pack_ids(ids):
+    return _pack("q", (int(i) for i in ids))
+
+
+def unpack_ids(data):
+    return _unpack("q", data)
+
+
+def pack_indexes(indexes):
+    return _pack("I", indexes)
+
+
+def unpack_indexes(data):
+    return _unpack("I", data)
+
+
+def encode_members(members):
+    """
+    Encodes a list of member dicts into columns
+    Nicknames are stored as a sparse map and role memberships as a list of member indexes per role
+    """
+    ids = []
+    nicks = {}
+    roles = {}
+    deaf = []
+    mute = []
+    for index, member in enumerate(members):
+        ids.append(member["id"])
+        if member.get("nick") is not None:
+            nicks[str(index)] = member["nick"]
+
+        for role_id in member.get("roles", []):
+            roles.setdefault(str(role_id), []).append(index)
+
+        if member.get("deaf"):
+            deaf.append(index)
+
+        if member.get("mute"):
+            mute.append(index)
+
+    return {
+        "ids": pack_ids(ids),
+        "nicks": nicks,
+        "roles": {role_id: pack_indexes(indexes) for role_id, indexes in roles.items()},
+        "deaf": pack_indexes(deaf),
+        "mute": pack_indexes(mute)
+    }
+
+
+def decode_members(columns):
+    ids = unpack_ids(columns["ids"])
+    members = [
+        {
+            "nick": None,
+            "roles": [],
+            "deaf": False,
+            "mute": False,
+            "id": member_id
+        }
+        for member_id in ids
+    ]
+    for index, nick in columns["nicks"].items():
+        members[int(index)]["nick"] = nick
+
+    for role_id, indexes in columns["roles"].items():
+        for index in unpack_indexes(indexes):
+            members[index]["roles"].append(int(role_id))
+
+    for index in unpack_indexes(columns["deaf"]):
+        members[index]["deaf"] = True
+
+    for index in unpack_indexes(columns["mute"]):
+        members[index]["mute"] = True
+
+    return members
+
+
+class BanColumns:
+    """
+    Builds the columns for bans incrementally, so pages of bans can be added as they are fetched
+    """
+    def __init__(self):
+        self.ids = []
+        self.reasons = []
+        self.reason_indexes = []
+        self._reason_lookup = {}
+
+    def add(self, user_id, reason):
+        self.ids.append(int(user_id))
+        index = self._reason_lookup.get(reason)
+        if index is None:
+            index = self._reason_lookup[reason] = len(self.reasons)
+            self.reasons.append(reason)
+
+        self.reason_indexes.append(index)
+
+    def encode(self):
+        return {
+            "ids": pack_ids(self.ids),
+            "reasons": self.reasons,
+            "reason_indexes": pack_indexes(self.reason_indexes)
+        }
+
+
+def encode_bans(bans):
+    columns = BanColumns()
+    for ban in bans:
+        columns.add(ban["id"], ban.get("reason"))
+
+    return columns.encode()
+
+
+def decode_bans(columns):
+    reasons = columns["reasons"]
+    return [
+        {
+            "reason": reasons[reason_index],
+            "id": user_id
+        }
+        for user_id, reason_index in zip(unpack_ids(columns["ids"]), unpack_indexes(columns["reason_indexes"]))
+    ]
+
+
+def is_encoded(section):
+    return isinstance(section, dict)
+
+
+def encode(data):
+    """
+    Encodes the members and bans of backup data in place
+    """
+    if "members" in data and not is_encoded(data["members"]):
+        data["members"] = encode_members(data["members"])
+
+    if "bans" in data and not is_encoded(data["bans"]):
+        data["bans"] = encode_bans(data["bans"])
+
+    return data
+
+
+def decode(data):
+    """
+    Turns encoded members and bans of backup data back into lists of dicts in place
+    """
+    if is_encoded(data.get("members")):
+        data["members"] = decode_members(data["members"])
+
+    if is_encoded(data.get("bans")):
+        data["bans"] = decode_bans(data["bans"])
+
+    return data
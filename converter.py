@@ -1,179 +1,179 @@
 from motor.motor_asyncio import AsyncIOMotorClient
+from concurrent.futures import ProcessPoolExecutor
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, DocumentTooLarge
+from datetime import datetime
+from os import environ as env
 import asyncio
-import xenon_worker as wkr
+import os
+import time
 import traceback
 
-loop = asyncio.get_event_loop()
-old_db = AsyncIOMotorClient("mongodb://144.91.118.247:8899").xenon
-new_db = AsyncIOMotorClient().xenon
-
-
-async def convert_and_insert(backup):
-    data = backup["backup"]
-    new_data = {
-        "id": data["id"],
-        "name": data["name"],
-        "mfa_level": data.get("mfa_level", 0),
-        "premium_tier": data.get("premium_tier", 0),
-        "explicit_content_filter": 0,
-        "large": data.get("large", False),
-        "default_message_notifications": data.get("default_message_notifications", 1),
-        "icon": data["icon_url"].split("/")[-1].split(".")[0] if "icon_url" in data else None,
-        "system_channel_flags": data.get("system_channel_flags", 2),
-        "preferred_locale": data.get("system_channel_flags", "en-US"),
-        "region": data.get("region", "europe"),
-        "premium_subscription_count": data.get("premium_subscription_count", 0),
-        "member_count": data.get("member_count", 0),
-        "features": data.get("features", []),
-        "verification_level": 3,
-        "owner_id": data["owner"],
-        "afk_timeout": data.get("afk_timeout", 3600),
-        "roles": [],
-        "members": [
-            {
-                "nick": member.get("nick"),
-                "roles": member["roles"],
-                "deaf": False,
-                "mute": False,
-                "id": member["id"]
-            }
-            for member in data["members"]
-        ],
-        "bans": [
-            {
-                "reason": ban.get("reason"),
-                "id": ban["user"]
-            }
-            for ban in data.get("bans", [])
-        ],
-        "channels": [],
-        "messages": {}
-    }
-
-    pos_counter = 0
-
-    for role in data["roles"]:
-        new_data["roles"].append({
-            **role,
-            "position": role.get("position") or pos_counter
-        })
+import migrations
+import messages
 
-        pos_counter += 1
-
-    pos_counter = 0
-
-    for channel in data["text_channels"]:
-        new_data["channels"].append({
-            "id": channel["id"],
-            "name": channel["name"],
-            "type": 0,
-            "position": channel.get("position") or pos_counter,
-            "nsfw": channel.get("nsfw", False),
-            "rate_limit_per_user": channel.get("slowmode_delay", 0),
-            "parent_id": channel.get("category", None),
-            "topic": channel.get("topic", None),
-            "permission_overwrites": [
-                {
-                    "id": obj_id,
-                    "type": None,
-                    "allow": wkr.Permissions(**{key: True for key, value in overwrites.items() if value}).value,
-                    "deny": wkr.Permissions(**{key: True for key, value in overwrites.items() if not value}).value
-                }
-                for obj_id, overwrites in channel.get("overwrites", {}).items()
-            ]
-        })
+BATCH_SIZE = int(env.get("BATCH_SIZE") or "500")
+WORKERS = int(env.get("WORKERS") or os.cpu_count() or 1)
+CHECKPOINT_ID = "backups"
 
-        new_data["messages"][channel["id"]] = [{
-                "id": msg.get("id", "0"),
-                "content": msg.get("content"),
-                "author": {
-                    "id": msg["author"].get("id", "0"),
-                    "username": msg["author"]["name"],
-                    "discriminator": msg["author"]["discriminator"],
-                    "avatar": msg["author"]["avatar_url"].split("/")[-1].split(".")[0]
-                    if msg["author"].get("avatar_url") else None
-                },
-                "pinned": msg["pinned"],
-                "attachments": [
-                    {
-                        "filename": attachment,
-                        "url": attachment
-                    }
-                    for attachment in msg["attachments"]
-                ],
-                "embeds": msg["embeds"]
-            }
-            for msg in reversed(channel.get("messages", []))
-        ]
+old_db = AsyncIOMotorClient(env.get("OLD_MONGO_URL") or "mongodb://144.91.118.247:8899").xenon
+new_db = AsyncIOMotorClient(env.get("MONGO_URL") or "mongodb://localhost").xenon
 
-        pos_counter += 1
-
-    for channel in data["voice_channels"]:
-        new_data["channels"].append({
-            "id": channel["id"],
-            "name": channel["name"],
-            "type": 2,
-            "position": channel.get("position") or pos_counter,
-            "nsfw": channel.get("nsfw", False),
-            "rate_limit_per_user": channel.get("slowmode_delay", 0),
-            "parent_id": channel.get("category", None),
-            "permission_overwrites": [
-                {
-                    "id": obj_id,
-                    "type": None,
-                    "allow": wkr.Permissions(**{key: True for key, value in overwrites.items() if value}).value,
-                    "deny": wkr.Permissions(**{key: True for key, value in overwrites.items() if not value}).value
-                }
-                for obj_id, overwrites in channel.get("overwrites", {}).items()
-            ],
-            "bitrate": channel.get("bitrate", 64000),
-            "user_limit": channel.get("user_limit", 0)
-        })
 
-        pos_counter += 1
-
-    for channel in data["categories"]:
-        new_data["channels"].append({
-            "id": channel["id"],
-            "name": channel["name"],
-            "type": 4,
-            "position": channel.get("position") or pos_counter,
-            "nsfw": channel.get("nsfw", False),
-            "permission_overwrites": [
-                {
-                    "id": obj_id,
-                    "type": None,
-                    "allow": wkr.Permissions(**{key: True for key, value in overwrites.items() if value}).value,
-                    "deny": wkr.Permissions(**{key: True for key, value in overwrites.items() if not value}).value
-                }
-                for obj_id, overwrites in channel.get("overwrites", {}).items()
-            ]
+def convert(backup):
+    result = migrations.upgrade(backup)
+    result["_id"] = str(result["_id"])
+    return result
+
+
+def convert_batch(backups):
+    """
+    Runs inside of the process pool, returns the converted backups and the ids of the ones that failed
+    """
+    converted = []
+    failed = []
+    for backup in backups:
+        try:
+            converted.append(convert(backup))
+        except Exception:
+            failed.append((backup["_id"], traceback.format_exc()))
+
+    return converted, failed
+
+
+async def read_batches(queue, after):
+    filter = {} if after is None else {"_id": {"$gt": after}}
+    batch = []
+    try:
+        async for backup in old_db.backups.find(filter, sort=[("_id", 1)], batch_size=BATCH_SIZE):
+            batch.append(backup)
+            if len(batch) >= BATCH_SIZE:
+                await queue.put(batch)
+                batch = []
+
+        if batch:
+            await queue.put(batch)
+
+    finally:
+        # Also stops the converter if reading failed, the error is raised when the reader is awaited
+        await queue.put(None)
+
+
+async def write_messages(converted):
+    chunks = [
+        chunk
+        for result in converted
+        for chunk in messages.chunk_messages(result["_id"], result.pop("messages", None) or {})
+    ]
+    if not chunks:
+        return []
+
+    try:
+        await new_db.backup_messages.bulk_write([
+            ReplaceOne({"_id": chunk["_id"]}, chunk, upsert=True)
+            for chunk in chunks
+        ], ordered=False)
+    except BulkWriteError as e:
+        return list({
+            (chunks[error["index"]]["backup"], error.get("errmsg"))
+            for error in e.details.get("writeErrors", [])
         })
 
-        pos_counter += 1
+    return []
 
-    result = {
-        "_id": str(backup["_id"]),
-        "creator": str(backup["creator"]),
-        "timestamp": backup["timestamp"],
-        "data": new_data
-    }
 
-    await new_db.backups.replace_one({"_id": result["_id"]}, result, upsert=True)
+async def write_batch(converted):
+    if not converted:
+        return []
 
+    failed = await write_messages(converted)
+    try:
+        await new_db.backups.bulk_write([
+            ReplaceOne({"_id": result["_id"]}, result, upsert=True)
+            for result in converted
+        ], ordered=False)
+    except BulkWriteError as e:
+        return failed + [
+            (converted[error["index"]]["_id"], error.get("errmsg"))
+            for error in e.details.get("writeErrors", [])
+        ]
+    except DocumentTooLarge:
+        # The driver rejects the whole batch, so we have to find the culprits one by one
+        for result in converted:
+            try:
+                await new_db.backups.replace_one({"_id": result["_id"]}, result, upsert=True)
+            except DocumentTooLarge:
+                failed.append((result["_id"], traceback.format_exc()))
 
-async def run():
-    i = 0
-    async for backup in old_db.backups.find({"_id": "iqhomtk9jk66tz57"}):
-        i += 1
-        if i % 1000 == 0:
-            print(i)
+        return failed
+
+    return failed
 
-        try:
-            await convert_and_insert(backup)
-        except:
-            print(backup["_id"])
-            traceback.print_exc()
 
+async def dead_letter(failed):
+    if not failed:
+        return
 
-loop.run_until_complete(run())
+    await new_db.migration_failures.bulk_write([
+        ReplaceOne(
+            {"_id": backup_id},
+            {"_id": backup_id, "error": error, "timestamp": datetime.utcnow()},
+            upsert=True
+        )
+        for backup_id, error in failed
+    ], ordered=False)
+
+
+async def run():
+    loop = asyncio.get_event_loop()
+    await messages.create_indexes(new_db)
+    checkpoint = await new_db.migrations.find_one({"_id": CHECKPOINT_ID})
+    after = checkpoint["last_id"] if checkpoint is not None else None
+    if after is not None:
+        print(f"Resuming after {after}")
+
+    # The next batches are read while the current one is converted and written
+    queue = asyncio.Queue(maxsize=2)
+    reader = asyncio.ensure_future(read_batches(queue, after))
+
+    total = 0
+    failed_total = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                break
+
+            batch_start = time.perf_counter()
+            chunk_size = max(len(batch) // WORKERS, 1)
+            results = await asyncio.gather(*[
+                loop.run_in_executor(pool, convert_batch, batch[i:i + chunk_size])
+                for i in range(0, len(batch), chunk_size)
+            ])
+
+            converted = [backup for result, _ in results for backup in result]
+            failed = [failure for _, result in results for failure in result]
+            failed.extend(await write_batch(converted))
+            await dead_letter(failed)
+
+            # The checkpoint only moves forward once the whole batch is persisted
+            await new_db.migrations.update_one(
+                {"_id": CHECKPOINT_ID},
+                {"$set": {"last_id": batch[-1]["_id"], "timestamp": datetime.utcnow()}, "$inc": {"count": len(batch)}},
+                upsert=True
+            )
+
+            total += len(batch)
+            failed_total += len(failed)
+            now = time.perf_counter()
+            print(f"{total} converted ({failed_total} failed), "
+                  f"{len(batch) / (now - batch_start):.0f} docs/s current, "
+                  f"{total / (now - start):.0f} docs/s average")
+
+    await reader
+    print(f"Done, {total} converted ({failed_total} failed) in {time.perf_counter() - start:.0f}s")
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(run())
@@ -0,0 +1,168 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
+from datetime import datetime, timezone
+from os import environ as env
+import argparse
+import asyncio
+import struct
+import zlib
+import msgpack
+
+import utils
+import quotas
+
+# Uncompressed bytes after which the compressed data is flushed to the sink
+CHUNK_SIZE = 1024 * 1024
+READ_SIZE = 64 * 1024
+INSERT_BATCH_SIZE = 100
+
+DATETIME_EXT = 1
+GZIP_WBITS = 31
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        timestamp = obj.replace(tzinfo=timezone.utc).timestamp()
+        return msgpack.ExtType(DATETIME_EXT, struct.pack("<q", int(timestamp * 1000)))
+
+    raise TypeError(f"Can't export objects of type {type(obj).__name__}")
+
+
+def _ext_hook(code, data):
+    if code == DATETIME_EXT:
+        milliseconds, = struct.unpack("<q", data)
+        return datetime.utcfromtimestamp(milliseconds / 1000)
+
+    return msgpack.ExtType(code, data)
+
+
+async def _records(db, user_id):
+    backups = db.backups.find({"creator": utils.snowflake_filter(user_id)}, batch_size=10)
+    async for backup in backups:
+        yield {"type": "backup", "doc": backup}
+        chunks = db.backup_messages.find({"backup": backup["_id"]}, batch_size=10)
+        async for chunk in chunks:
+            yield {"type": "messages", "doc": chunk}
+
+
+async def export_backups(db, user_id, sink):
+    """
+    Writes all backups of a user as a stream of msgpack records to a binary file-like sink
+
+    The stream is gzip compressed in chunks, so only one chunk is held in memory at a time.
+    Returns the number of exported backups.
+    """
+    compressor = zlib.compressobj(wbits=GZIP_WBITS)
+    packer = msgpack.Packer(default=_default, use_bin_type=True)
+    pending = 0
+    count = 0
+    async for record in _records(db, user_id):
+        if record["type"] == "backup":
+            count += 1
+
+        data = packer.pack(record)
+        pending += len(data)
+        sink.write(compressor.compress(data))
+        if pending >= CHUNK_SIZE:
+            sink.write(compressor.flush(zlib.Z_SYNC_FLUSH))
+            pending = 0
+
+    sink.write(compressor.flush())
+    return count
+
+
+async def _insert(collection, docs):
+    if not docs:
+        return 0
+
+    try:
+        result = await collection.insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        # Already existing documents are skipped
+        return e.details.get("nInserted", 0)
+
+
+async def import_backups(db, source, user_id=None):
+    """
+    Reads a stream that was created by export_backups from a binary file-like source and inserts it
+
+    If user_id is given, the backups are assigned to that user.
+    Returns the number of imported backups.
+    """
+    decompressor = zlib.decompressobj(wbits=GZIP_WBITS)
+    unpacker = msgpack.Unpacker(ext_hook=_ext_hook, raw=False)
+    collections = {
+        "backup": db.backups,
+        "messages": db.backup_messages
+    }
+    batches = {key: [] for key in collections.keys()}
+    creators = set()
+    count = 0
+
+    async def _flush(key):
+        nonlocal count
+        inserted = await _insert(collections[key], batches[key])
+        if key == "backup":
+            count += inserted
+
+        batches[key] = []
+
+    def _feed(data):
+        unpacker.feed(data)
+        for record in unpacker:
+            doc = record["doc"]
+            if record["type"] == "backup":
+                if user_id is not None:
+                    doc["creator"] = utils.snowflake(user_id)
+
+                creators.add(doc["creator"])
+
+            batches[record["type"]].append(doc)
+
+    while True:
+        data = source.read(READ_SIZE)
+        if not data:
+            break
+
+        _feed(decompressor.decompress(data))
+        for key, batch in batches.items():
+            if len(batch) >= INSERT_BATCH_SIZE:
+                await _flush(key)
+
+    _feed(decompressor.flush())
+    for key in collections.keys():
+        await _flush(key)
+
+    await quotas.reconcile_backup_counts(db, creators)
+    return count
+
+
+async def run(args):
+    db = AsyncIOMotorClient(env.get("MONGO_URL") or "mongodb://localhost").xenon
+    if args.command == "export":
+        with open(args.path, "wb") as sink:
+            count = await export_backups(db, args.user_id, sink)
+
+        print(f"Exported {count} backups to {args.path}")
+
+    else:
+        with open(args.path, "rb") as source:
+            count = await import_backups(db, source, user_id=args.user_id)
+
+        print(f"Imported {count} backups from {args.path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export and import all backups of a user")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = subparsers.add_parser("export")
+    export_parser.add_argument("user_id", type=int)
+    export_parser.add_argument("path")
+
+    import_parser = subparsers.add_parser("import")
+    import_parser.add_argument("path")
+    import_parser.add_argument("user_id", type=int, nargs="?", default=None)
+
+    asyncio.get_event_loop().run_until_complete(run(parser.parse_args()))
@@ -0,0 +1,61 @@
+import pymongo
+
+CHUNK_SIZE = 100
+WRITE_BATCH_SIZE = 100
+
+
+def chunk_messages(backup_id, messages):
+    """
+    Splits the messages of each channel into fixed-size chunk documents
+    """
+    for channel_id, channel_messages in messages.items():
+        for offset in range(0, len(channel_messages), CHUNK_SIZE):
+            index = offset // CHUNK_SIZE
+            yield {
+                "_id": f"{backup_id}-{channel_id}-{index}",
+                "backup": backup_id,
+                "channel": channel_id,
+                "index": index,
+                "messages": channel_messages[offset:offset + CHUNK_SIZE]
+            }
+
+
+async def create_indexes(db):
+    await db.backup_messages.create_index(
+        [("backup", pymongo.ASCENDING), ("channel", pymongo.ASCENDING), ("index", pymongo.ASCENDING)],
+        unique=True
+    )
+
+
+async def store(db, backup_id, messages):
+    batch = []
+    for chunk in chunk_messages(backup_id, messages):
+        batch.append(pymongo.ReplaceOne({"_id": chunk["_id"]}, chunk, upsert=True))
+        if len(batch) >= WRITE_BATCH_SIZE:
+            await db.backup_messages.bulk_write(batch, ordered=False)
+            batch = []
+
+    if batch:
+        await db.backup_messages.bulk_write(batch, ordered=False)
+
+
+async def channels(db, backup_id):
+    return await db.backup_messages.distinct("channel", {"backup": backup_id})
+
+
+async def iter_messages(db, backup_id, channel_id):
+    """
+    Yields the messages of a channel in their original order, only one chunk is held in memory at a time
+    """
+    chunks = db.backup_messages.find(
+        {"backup": backup_id, "channel": channel_id},
+        sort=[("index", pymongo.ASCENDING)],
+        batch_size=1
+    )
+    async for chunk in chunks:
+        for message in chunk["messages"]:
+            yield message
+
+
+async def delete(db, *backup_ids):
+    await db.backup_messages.delete_many({"backup": {"$in": backup_ids}})
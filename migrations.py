@@ -0,0 +1,268 @@
+import xenon_worker as wkr
+
+import utils
+import messages
+import columnar
+
+CURRENT_VERSION = 4
+
+upgraders = {}
+
+
+def upgrader(version):
+    """
+    Registers a function that upgrades a backup document from the given version to the next one
+    """
+    def predicate(callback):
+        upgraders[version] = callback
+        return callback
+
+    return predicate
+
+
+def get_version(backup):
+    if "version" in backup:
+        return backup["version"]
+
+    # Documents from before the version field was introduced
+    return 0 if "backup" in backup else 1
+
+
+def needs_upgrade(backup):
+    return get_version(backup) < CURRENT_VERSION
+
+
+def upgrade(backup):
+    """
+    Upgrades a backup document to the current version
+
+    Messages that were moved out of the document are left in the "messages" key and have to be stored by save()
+    """
+    version = get_version(backup)
+    while version < CURRENT_VERSION:
+        backup = upgraders[version](backup)
+        version += 1
+
+    backup["version"] = version
+    return backup
+
+
+def unchanged_filter(backup):
+    """
+    Matches the document only if it wasn't upgraded or transferred since it was read
+    """
+    filter = {"_id": backup["_id"], "version": backup.get("version", {"$exists": False})}
+    if "creator" in backup:
+        filter["creator"] = backup["creator"]
+
+    return filter
+
+
+async def save(db, backup, filter):
+    """
+    Writes an upgraded backup, returns False if the document doesn't match the filter anymore
+    """
+    channel_messages = backup.pop("messages", None)
+    if channel_messages:
+        await messages.store(db, backup["_id"], channel_messages)
+
+    result = await db.backups.replace_one(filter, backup)
+    return result.matched_count > 0
+
+
+async def ensure_upgraded(db, backup):
+    """
+    Upgrades a backup document that was just read and writes the upgraded version back
+    """
+    if backup is None or not needs_upgrade(backup):
+        return backup
+
+    # The document might have been read with a projection
+    backup = await db.backups.find_one({"_id": backup["_id"]})
+    if backup is None:
+        return None
+
+    filter = unchanged_filter(backup)
+    backup = upgrade(backup)
+    if await save(db, backup, filter):
+        return backup
+
+    # Already upgraded by someone else, transferred or deleted in the meantime
+    current = await db.backups.find_one({"_id": backup["_id"]})
+    if current is None:
+        await messages.delete(db, backup["_id"])
+        return None
+
+    return await ensure_upgraded(db, current)
+
+
+def convert_overwrites(overwrites):
+    return [
+        {
+            "id": obj_id,
+            "type": None,
+            "allow": wkr.Permissions(**{key: True for key, value in overwrite.items() if value}).value,
+            "deny": wkr.Permissions(**{key: True for key, value in overwrite.items() if not value}).value
+        }
+        for obj_id, overwrite in overwrites.items()
+    ]
+
+
+@upgrader(0)
+def upgrade_legacy(backup):
+    """
+    Converts backups from the old bot to the current format
+    """
+    data = backup["backup"]
+    new_data = {
+        "id": data["id"],
+        "name": data["name"],
+        "mfa_level": data.get("mfa_level", 0),
+        "premium_tier": data.get("premium_tier", 0),
+        "explicit_content_filter": 0,
+        "large": data.get("large", False),
+        "default_message_notifications": data.get("default_message_notifications", 1),
+        "icon": data["icon_url"].split("/")[-1].split(".")[0] if "icon_url" in data else None,
+        "system_channel_flags": data.get("system_channel_flags", 2),
+        "preferred_locale": data.get("system_channel_flags", "en-US"),
+        "region": data.get("region", "europe"),
+        "premium_subscription_count": data.get("premium_subscription_count", 0),
+        "member_count": data.get("member_count", 0),
+        "features": data.get("features", []),
+        "verification_level": 3,
+        "owner_id": data["owner"],
+        "afk_timeout": data.get("afk_timeout", 3600),
+        "roles": [],
+        "members": [
+            {
+                "nick": member.get("nick"),
+                "roles": member["roles"],
+                "deaf": False,
+                "mute": False,
+                "id": member["id"]
+            }
+            for member in data["members"]
+        ],
+        "bans": [
+            {
+                "reason": ban.get("reason"),
+                "id": ban["user"]
+            }
+            for ban in data.get("bans", [])
+        ],
+        "channels": [],
+        "messages": {}
+    }
+
+    pos_counter = 0
+
+    for role in data["roles"]:
+        new_data["roles"].append({
+            **role,
+            "position": role.get("position") or pos_counter
+        })
+
+        pos_counter += 1
+
+    pos_counter = 0
+
+    for channel in data["text_channels"]:
+        new_data["channels"].append({
+            "id": channel["id"],
+            "name": channel["name"],
+            "type": 0,
+            "position": channel.get("position") or pos_counter,
+            "nsfw": channel.get("nsfw", False),
+            "rate_limit_per_user": channel.get("slowmode_delay", 0),
+            "parent_id": channel.get("category", None),
+            "topic": channel.get("topic", None),
+            "permission_overwrites": convert_overwrites(channel.get("overwrites", {}))
+        })
+
+        new_data["messages"][channel["id"]] = [{
+                "id": msg.get("id", "0"),
+                "content": msg.get("content"),
+                "author": {
+                    "id": msg["author"].get("id", "0"),
+                    "username": msg["author"]["name"],
+                    "discriminator": msg["author"]["discriminator"],
+                    "avatar": msg["author"]["avatar_url"].split("/")[-1].split(".")[0]
+                    if msg["author"].get("avatar_url") else None
+                },
+                "pinned": msg["pinned"],
+                "attachments": [
+                    {
+                        "filename": attachment,
+                        "url": attachment
+                    }
+                    for attachment in msg["attachments"]
+                ],
+                "embeds": msg["embeds"]
+            }
+            for msg in reversed(channel.get("messages", []))
+        ]
+
+        pos_counter += 1
+
+    for channel in data["voice_channels"]:
+        new_data["channels"].append({
+            "id": channel["id"],
+            "name": channel["name"],
+            "type": 2,
+            "position": channel.get("position") or pos_counter,
+            "nsfw": channel.get("nsfw", False),
+            "rate_limit_per_user": channel.get("slowmode_delay", 0),
+            "parent_id": channel.get("category", None),
+            "permission_overwrites": convert_overwrites(channel.get("overwrites", {})),
+            "bitrate": channel.get("bitrate", 64000),
+            "user_limit": channel.get("user_limit", 0)
+        })
+
+        pos_counter += 1
+
+    for channel in data["categories"]:
+        new_data["channels"].append({
+            "id": channel["id"],
+            "name": channel["name"],
+            "type": 4,
+            "position": channel.get("position") or pos_counter,
+            "nsfw": channel.get("nsfw", False),
+            "permission_overwrites": convert_overwrites(channel.get("overwrites", {}))
+        })
+
+        pos_counter += 1
+
+    return {
+        "_id": backup["_id"],
+        "creator": str(backup["creator"]),
+        "timestamp": backup["timestamp"],
+        "data": new_data
+    }
+
+
+@upgrader(1)
+def upgrade_external_messages(backup):
+    """
+    Moves the messages out of the backup document, they are stored in their own collection
+    """
+    backup["messages"] = backup["data"].pop("messages", None) or {}
+    return backup
+
+
+@upgrader(2)
+def upgrade_columnar(backup):
+    """
+    Encodes members and bans as columns
+    """
+    columnar.encode(backup["data"])
+    return backup
+
+
+@upgrader(3)
+def upgrade_snowflakes(backup):
+    """
+    Stores all snowflakes as int64 instead of strings
+    """
+    backup["creator"] = utils.snowflake(backup["creator"])
+    utils.normalize_guild_ids(backup["data"])
+    return backup
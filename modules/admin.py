@@ -8,6 +8,8 @@ import io
 
 import utils
 import checks
+import audit
+from .audit_logs import stats_embed
 
 
 class StaffListMenu(wkr.ListMenu):
@@ -156,6 +158,58 @@ class Admin(wkr.Module):
             ]
         })
 
+    @wkr.Module.command(hidden=True)
+    @checks.is_staff(level=checks.StaffLevel.MOD)
+    async def auditstats(self, ctx, server_id, days: int = 30):
+        """
+        Get the audit log stats of any server
+        """
+        days = min(max(days, 1), 365)
+        stats = await audit.guild_stats(ctx.bot.db, server_id, days=days)
+        embed = stats_embed(stats, days)
+        embed["description"] = f"Actions taken on the server `{server_id}` in the last **{days} days**."
+        raise ctx.f.INFO(embed=embed)
+
+    @wkr.Module.command(hidden=True)
+    @checks.is_staff(level=checks.StaffLevel.MOD)
+    async def traffic(self, ctx):
+        """
+        Get the request lanes and concurrency windows of this worker
+        """
+        fields = [
+            {
+                "name": f"{name.title()} Lane",
+                "value": f"Queued: `{values['depth']}`\n"
+                         f"Requests: `{values['granted']}`\n"
+                         f"Avg Wait: `{values['avg_wait']}s`\n"
+                         f"Max Wait: `{values['max_wait']}s`",
+                "inline": True
+            }
+            for name, values in ctx.bot.lanes.metrics().items()
+        ]
+        fields.extend(
+            {
+                "name": route_class.title(),
+                "value": f"Window: `{values['window']}`\n"
+                         f"In Flight: `{values['in_flight']}`\n"
+                         f"Successes: `{values['successes']}`\n"
+                         f"Rate Limits: `{values['rate_limits']}`",
+                "inline": True
+            }
+            for route_class, values in ctx.bot.traffic.metrics().items()
+        )
+        loaders = ctx.bot.loaders.metrics()
+        fields.append({
+            "name": "Loaders",
+            "value": f"Running: `{loaders['running']}/{loaders['max_loaders']}`\n"
+                     f"Queued: `{loaders['queued']}`",
+            "inline": True
+        })
+        raise ctx.f.INFO(embed={
+            "title": "Traffic",
+            "fields": fields
+        })
+
     @wkr.Module.command(hidden=True)
     @checks.is_staff()
     async def staff(self, ctx):
@@ -1,8 +1,9 @@
 import xenon_worker as wkr
 import pymongo
-from datetime import datetime, timedelta
+from datetime import datetime
 
 import utils
+import audit
 from utils import AuditLogType
 
 text_formats = {
@@ -13,7 +14,7 @@ text_formats = {
     AuditLogType.TEMPLATE_LOAD: "<@{user}> loaded a template on this server",
     AuditLogType.COPY: "<@{user}> copied the server with the id `{source}` to the server with the id `{target}`",
     AuditLogType.CHATLOG_CREATE: "<@{user}> created a chatlog of the channel <#{channel}>",
-    AuditLogType.CHATLOG_LOAD: "<@{user}> loaded a chatlog in the channel <#{channel}>",
+    AuditLogType.CHATLOG_LOAD: "<@{user}> loaded the messages of a backup into {channels} channels",
     AuditLogType.MESSAGE_SYNC_CREATE: "<@{user}> created a message sync from <#{source}> to "
                                       "<#{target}> with the id `{id}`",
     AuditLogType.BAN_SYNC_CREATE: "<@{user}> created a ban sync from the server with the id `{source}` to "
@@ -24,19 +25,57 @@ text_formats = {
 }
 
 
+def stats_embed(stats, days):
+    return {
+        "title": "Audit Log Stats",
+        "description": f"Actions taken on this server in the last **{days} days**.",
+        "fields": [
+            {
+                "name": type.name.replace("_", " ").title(),
+                "value": str(stats.get(type.value, 0)),
+                "inline": True
+            }
+            for type in AuditLogType
+        ]
+    }
+
+
 class AuditLogList(wkr.ListMenu):
     embed_kwargs = {"title": "Audit Logs"}
 
+    async def _find_logs(self):
+        """
+        Walks the monthly buckets from the newest to the oldest and only queries the ones that contain the page
+        """
+        filter = {"guilds": self.ctx.guild_id}
+        skip = self.page * 10
+        limit = 10
+
+        # The unpartitioned collection is kept as the oldest bucket until it runs empty
+        for name in audit.bucket_names() + ["audit_logs"]:
+            collection = self.ctx.bot.db[name]
+            if skip > 0:
+                count = await collection.count_documents(filter, limit=skip)
+                if count < skip:
+                    skip -= count
+                    continue
+
+            logs = collection.find(
+                filter=filter,
+                sort=[("timestamp", pymongo.DESCENDING)],
+                skip=skip,
+                limit=limit
+            )
+            skip = 0
+            async for audit_log in logs:
+                limit -= 1
+                yield audit_log
+
+            if limit <= 0:
+                return
+
     async def get_items(self):
-        args = {
-            "limit": 10,
-            "skip": self.page * 10,
-            "sort": [("timestamp", pymongo.DESCENDING)],
-            "filter": {
-                "guilds": self.ctx.guild_id,
-            }
-        }
-        logs = self.ctx.bot.db.audit_logs.find(**args)
+        logs = self._find_logs()
         items = []
         async for audit_log in logs:
             type = AuditLogType(audit_log["type"])
@@ -54,14 +93,30 @@ class AuditLogs(wkr.Module):
         await self.bot.db.audit_logs.create_index([("timestamp", pymongo.ASCENDING)])
         await self.bot.db.audit_logs.create_index([("user", pymongo.ASCENDING)])
         await self.bot.db.audit_logs.create_index([("guilds", pymongo.ASCENDING)])
+        await self.bot.db.audit_log_stats.create_index(
+            [("guild", pymongo.ASCENDING), ("day", pymongo.ASCENDING)],
+            unique=True
+        )
+        await self.bot.db.audit_log_stats.create_index(
+            [("day", pymongo.ASCENDING)],
+            expireAfterSeconds=int(audit.RETENTION.total_seconds())
+        )
 
     @wkr.Module.task(hours=1)
     async def audit_log_retention(self):
-        await self.bot.db.audit_logs.delete_many({
-            "timestamp": {
-                "$lte": datetime.utcnow() - timedelta(days=365)
-            }
-        })
+        if not await utils.acquire_lease(self.bot.redis, "audit_log_retention", 55 * 60):
+            return
+
+        # Expired buckets are dropped as a whole instead of deleting the logs one by one
+        limit = datetime.utcnow() - audit.RETENTION
+        names = await self.bot.db.list_collection_names(filter={"name": {"$regex": f"^{audit.BUCKET_PREFIX}"}})
+        for name in names:
+            if audit.bucket_end(name) <= limit:
+                await self.bot.db.drop_collection(name)
+
+        # Logs from before the partitioning
+        if await self.bot.db.audit_logs.estimated_document_count() > 0:
+            await self.bot.db.audit_logs.delete_many({"timestamp": {"$lte": limit}})
 
     @wkr.Module.command(aliases=("logs",))
     @wkr.guild_only
@@ -80,3 +135,24 @@ class AuditLogs(wkr.Module):
         """
         menu = AuditLogList(ctx)
         await menu.start()
+
+    @auditlogs.command(aliases=("stat", "summary"))
+    @wkr.cooldown(1, 10, bucket=wkr.CooldownType.GUILD)
+    async def stats(self, ctx, days: int = 30):
+        """
+        Get the number of actions that were taken on this server per type
+
+
+        __Arguments__
+
+        **days**: The number of days to include (max 365)
+
+
+        __Examples__
+
+        ```{b.prefix}auditlogs stats```
+        ```{b.prefix}auditlogs stats 7```
+        """
+        days = min(max(days, 1), 365)
+        stats = await audit.guild_stats(ctx.bot.db, ctx.guild_id, days=days)
+        raise ctx.f.INFO(embed=stats_embed(stats, days))
@@ -4,13 +4,21 @@ import pymongo
 from pymongo import errors as mongoerrors
 from datetime import datetime, timedelta
 import random
-import msgpack
+import traceback
 
 import utils
 import checks
-from backups import BackupSaver, BackupLoader
+import migrations
+import messages
+import columnar
+import quotas
+import retention
+import traffic
+from backups import BackupSaver, prepare_loader, confirm_load, run_load
 
 MAX_BACKUPS = 15
+UPGRADE_BATCH_SIZE = 1000
+UPGRADE_CHECKPOINT_ID = "upgrade_task"
 
 
 class BackupListMenu(wkr.ListMenu):
@@ -22,12 +30,21 @@ class BackupListMenu(wkr.ListMenu):
             "skip": self.page * 10,
             "sort": [("timestamp", pymongo.DESCENDING)],
             "filter": {
-                "creator": self.ctx.author.id,
+                "creator": utils.snowflake_filter(self.ctx.author.id),
+            },
+            "projection": {
+                "timestamp": True,
+                "interval": True,
+                "version": True,
+                "data.name": True,
+                # Only used to detect legacy backups
+                "backup.id": True
             }
         }
         backups = self.ctx.bot.db.backups.find(**args)
         items = []
         async for backup in backups:
+            backup = await migrations.ensure_upgraded(self.ctx.bot.db, backup)
             items.append((
                 backup["_id"].upper() + (" ⏲️" if backup.get("interval") else ""),
                 f"{backup['data']['name']} (`{utils.datetime_to_string(backup['timestamp'])} UTC`)"
@@ -42,12 +59,14 @@ class Backups(wkr.Module):
         await self.bot.db.backups.create_index([("creator", pymongo.ASCENDING)])
         await self.bot.db.backups.create_index([("timestamp", pymongo.ASCENDING)])
         await self.bot.db.backups.create_index([("data.id", pymongo.ASCENDING)])
+        await self.bot.db.backups.create_index([("version", pymongo.ASCENDING)])
         await self.bot.db.intervals.create_index([("guild", pymongo.ASCENDING), ("user", pymongo.ASCENDING)])
         await self.bot.db.intervals.create_index([("next", pymongo.ASCENDING)])
         await self.bot.db.id_translators.create_index(
             [("source_id", pymongo.ASCENDING), ("target_id", pymongo.ASCENDING)],
             unique=True
         )
+        await messages.create_indexes(self.bot.db)
 
     @wkr.Module.command(aliases=("backups", "bu"))
     @wkr.cooldown(1, 3, bucket=wkr.CooldownType.GUILD)
@@ -64,10 +83,18 @@ class Backups(wkr.Module):
         Transfer a backup to the specified user
         """
         user = await user(ctx)
-        res = await ctx.bot.db.backups.update_one({"_id": backup_id}, {"$set": {"creator": str(user.id)}})
-        if res.matched_count == 0:
+        old = await ctx.bot.db.backups.find_one_and_update(
+            {"_id": backup_id},
+            {"$set": {"creator": utils.snowflake(user.id)}},
+            projection={"creator": True, "interval": True}
+        )
+        if old is None:
             raise ctx.f.ERROR(f"There is **no backup** with the id `{backup_id.upper()}`.")
 
+        if not old.get("interval"):
+            await quotas.change_backup_count(ctx.bot.db, old["creator"], -1)
+            await quotas.change_backup_count(ctx.bot.db, user.id, 1)
+
         raise ctx.f.SUCCESS(f"Successfully transferred backup.")
 
     @backup.command(aliases=("c",))
@@ -86,33 +113,39 @@ class Backups(wkr.Module):
 
         ```{b.prefix}backup create```
         """
-        backup_count = await ctx.bot.db.backups.count_documents({"creator": ctx.author.id})
-        if backup_count >= MAX_BACKUPS:
+        if await quotas.reserve_backup(ctx.bot.db, ctx.author.id, MAX_BACKUPS) is None:
             raise ctx.f.ERROR(
-                f"You have **exceeded the maximum count** of backups. (`{backup_count}/{MAX_BACKUPS}`)\n"
+                f"You have **exceeded the maximum count** of backups. (`{MAX_BACKUPS}/{MAX_BACKUPS}`)\n"
                 f"You need to **delete old backups** with `{ctx.bot.prefix}backup delete <id>` or **buy "
                 f"[Xenon Premium](https://www.patreon.com/merlinfuchs)** to create new backups.\n\n"
                 f"*You can view your current backups by doing `{ctx.bot.prefix}backup list`.*"
             )
 
-        status_msg = await ctx.f_send("**Creating Backup** ...", f=ctx.f.WORKING)
-        guild = await ctx.fetch_full_guild()
-        backup = BackupSaver(ctx.client, guild)
-        await backup.save()
-
-        backup_id = utils.unique_id()
         try:
-            await ctx.bot.db.backups.insert_one({
-                "_id": backup_id,
-                "creator": ctx.author.id,
-                "timestamp": datetime.utcnow(),
-                "data": backup.data
-            })
-        except mongoerrors.DocumentTooLarge:
-            raise ctx.f.ERROR(
-                f"This backups **exceeds** the maximum size of **16 Megabyte**. Your server probably has a lot of "
-                f"members and channels containing messages. Try to create a new backup with less messages (chatlog)."
-            )
+            status_msg = await ctx.f_send("**Creating Backup** ...", f=ctx.f.WORKING)
+            guild = await ctx.fetch_full_guild()
+            backup = BackupSaver(ctx.client, guild)
+            await backup.save()
+
+            backup_id = utils.unique_id()
+            try:
+                await ctx.bot.db.backups.insert_one({
+                    "_id": backup_id,
+                    "creator": utils.snowflake(ctx.author.id),
+                    "timestamp": datetime.utcnow(),
+                    "version": migrations.CURRENT_VERSION,
+                    "sizes": backup.sizes,
+                    "data": backup.data
+                })
+            except mongoerrors.DocumentTooLarge:
+                raise ctx.f.ERROR(
+                    f"This backups **exceeds** the maximum size of **16 Megabyte**. Your server probably has a lot of "
+                    f"members and channels containing messages. Try to create a new backup with less messages (chatlog)."
+                )
+        except Exception:
+            # Give back the reserved slot
+            await quotas.change_backup_count(ctx.bot.db, ctx.author.id, -1)
+            raise
 
         embed = ctx.f.format(f"Successfully **created backup** with the id `{backup_id.upper()}`.", f=ctx.f.SUCCESS)["embed"]
         embed.setdefault("fields", []).append({
@@ -120,6 +153,13 @@ class Backups(wkr.Module):
             "value": f"```{ctx.bot.prefix}backup load {backup_id.upper()}```\n"
                      f"```{ctx.bot.prefix}backup info {backup_id.upper()}```"
         })
+        if backup.trimmed:
+            embed["fields"].append({
+                "name": "Warning",
+                "value": f"Your server is too large to be saved completely. The following parts were **not saved**: "
+                         f"{', '.join(f'`{key}`' for key in backup.trimmed)}"
+            })
+
         await ctx.client.edit_message(status_msg, embed=embed)
         await ctx.bot.create_audit_log(utils.AuditLogType.BACKUP_CREATE, [ctx.guild_id], ctx.author.id)
 
@@ -147,80 +187,36 @@ class Backups(wkr.Module):
         Only roles: ```{b.prefix}backup load oj1xky11871fzrbu !* roles```
         Everything but bans: ```{b.prefix}backup load oj1xky11871fzrbu !bans```
         """
-        backup_d = await ctx.client.db.backups.find_one({"_id": backup_id, "creator": ctx.author.id})
+        backup_d = await ctx.client.db.backups.find_one(
+            {"_id": backup_id, "creator": utils.snowflake_filter(ctx.author.id)},
+            projection={"data.messages": False}
+        )
+        backup_d = await migrations.ensure_upgraded(ctx.client.db, backup_d)
         if backup_d is None:
             raise ctx.f.ERROR(f"You have **no backup** with the id `{backup_id.upper()}`.")
 
-        warning_msg = await ctx.f_send("Are you sure that you want to load this backup?\n"
-                                       f"Please put the managed role called `{ctx.bot.user.name}` above all other "
-                                       f"roles before clicking the ✅ reaction.\n\n"
-                                       "__**All channels and roles will get replaced!**__\n\n"
-                                       "*Also keep in mind that you can only load up to 250 roles per 48 hours.*",
-                                       f=ctx.f.WARNING)
-        reactions = ("✅", "❌")
-        for reaction in reactions:
-            await ctx.client.add_reaction(warning_msg, reaction)
-
-        try:
-            data, = await ctx.client.wait_for(
-                "message_reaction_add",
-                ctx.shard_id,
-                check=lambda d: d["message_id"] == warning_msg.id and
-                                d["user_id"] == ctx.author.id and
-                                d["emoji"]["name"] in reactions,
-                timeout=60
-            )
-        except asyncio.TimeoutError:
-            await ctx.client.delete_message(warning_msg)
-            return
-
-        await ctx.client.delete_message(warning_msg)
-        if data["emoji"]["name"] != "✅":
+        warning_text = "Are you sure that you want to load this backup?\n" \
+                       f"Please put the managed role called `{ctx.bot.user.name}` above all other " \
+                       f"roles before clicking the ✅ reaction.\n\n" \
+                       "__**All channels and roles will get replaced!**__\n\n" \
+                       "*Also keep in mind that you can only load up to 250 roles per 48 hours.*"
+        backup = await confirm_load(ctx, prepare_loader(
+            ctx.client,
+            ctx.fetch_full_guild(),
+            backup_d["data"],
+            utils.backup_options(options),
+            reason="Backup loaded by " + str(ctx.author)
+        ), warning_text)
+        if backup is None:
             return
 
-        guild = await ctx.fetch_full_guild()
-        backup = BackupLoader(ctx.client, guild, backup_d["data"], reason="Backup loaded by " + str(ctx.author))
-
-        await self.client.redis.publish("loaders:start", msgpack.packb({
+        await run_load(ctx, backup, {
             "id": ctx.guild_id,
             "type": "backup",
             "user_id": ctx.author.id,
             "source_id": backup.data["id"],
             "backup_id": backup_id
-        }))
-        try:
-            await backup.load(**utils.backup_options(options))
-
-            unpacked_ids = {
-                f"ids.{s}": t
-                for s, t in backup.id_translator.items()
-            }
-            await ctx.bot.db.id_translators.update_one(
-                {
-                    "target_id": ctx.guild_id,
-                    "source_id": backup.data["id"],
-                },
-                {
-                    "$set": {
-                        "target_id": ctx.guild_id,
-                        "source_id": backup.data["id"],
-                        **unpacked_ids
-                    },
-                    "$addToSet": {
-                        "loaders": ctx.author.id
-                    }
-                },
-                upsert=True
-            )
-        finally:
-            await self.client.redis.publish("loaders:done", msgpack.packb({
-                "id": ctx.guild_id,
-                "type": "backup",
-                "user_id": ctx.author.id,
-                "source_id": backup.data["id"],
-                "backup_id": backup_id
-            }))
-            await ctx.bot.create_audit_log(utils.AuditLogType.BACKUP_LOAD, [ctx.guild_id], ctx.author.id)
+        }, utils.AuditLogType.BACKUP_LOAD)
 
     @backup.command(aliases=("del", "remove", "rm"))
     @wkr.cooldown(5, 30)
@@ -236,8 +232,15 @@ class Backups(wkr.Module):
 
         ```{b.prefix}backup delete 3zpssue46g```
         """
-        result = await ctx.client.db.backups.delete_one({"_id": backup_id, "creator": ctx.author.id})
-        if result.deleted_count > 0:
+        backup = await ctx.client.db.backups.find_one_and_delete(
+            {"_id": backup_id, "creator": utils.snowflake_filter(ctx.author.id)},
+            projection={"interval": True}
+        )
+        if backup is not None:
+            if not backup.get("interval"):
+                await quotas.change_backup_count(ctx.client.db, ctx.author.id, -1)
+
+            await messages.delete(ctx.client.db, backup_id)
             raise ctx.f.SUCCESS("Successfully **deleted backup**.")
 
         else:
@@ -261,7 +264,7 @@ class Backups(wkr.Module):
 
         ```{b.prefix}backup purge```
         """
-        filter = {"creator": ctx.author.id}
+        filter = {"creator": utils.snowflake_filter(ctx.author.id)}
         if before is not None:
             try:
                 filter["timestamp"] = {
@@ -297,7 +300,15 @@ class Backups(wkr.Module):
         if data["emoji"]["name"] != "✅":
             return
 
-        await ctx.client.db.backups.delete_many(filter)
+        backups = [b async for b in ctx.client.db.backups.find(filter, projection={"_id": True, "interval": True})]
+        backup_ids = [b["_id"] for b in backups]
+        # Only the backups that count towards the limit give back a slot
+        result = await ctx.client.db.backups.delete_many({"_id": {"$in": [
+            b["_id"] for b in backups if not b.get("interval")
+        ]}})
+        await quotas.change_backup_count(ctx.client.db, ctx.author.id, -result.deleted_count)
+        await ctx.client.db.backups.delete_many({"_id": {"$in": [b["_id"] for b in backups if b.get("interval")]}})
+        await messages.delete(ctx.client.db, *backup_ids)
         raise ctx.f.SUCCESS("Successfully **deleted all your backups**.")
 
     @backup.command(aliases=("ls",))
@@ -330,12 +341,16 @@ class Backups(wkr.Module):
 
         ```{b.prefix}backup info 3zpssue46g```
         """
-        backup = await ctx.client.db.backups.find_one({"_id": backup_id, "creator": ctx.author.id})
+        backup = await ctx.client.db.backups.find_one(
+            {"_id": backup_id, "creator": utils.snowflake_filter(ctx.author.id)},
+            projection={"data.messages": False, "data.members": False, "data.bans": False}
+        )
+        backup = await migrations.ensure_upgraded(ctx.client.db, backup)
         if backup is None:
             raise ctx.f.ERROR(f"You have **no backup** with the id `{backup_id.upper()}`.")
 
         backup["data"].pop("members", None)
-        guild = wkr.Guild(backup["data"])
+        guild = wkr.Guild(columnar.decode(backup["data"]))
 
         channels = utils.channel_tree(guild.channels)
         if len(channels) > 1024:
@@ -395,7 +410,10 @@ class Backups(wkr.Module):
             await ctx.invoke("backup interval on " + " ".join(interval))
             return
 
-        interval = await ctx.bot.db.intervals.find_one({"guild": ctx.guild_id, "user": ctx.author.id})
+        interval = await ctx.bot.db.intervals.find_one({
+            "guild": utils.snowflake_filter(ctx.guild_id),
+            "user": utils.snowflake_filter(ctx.author.id)
+        })
         if interval is None:
             raise ctx.f.INFO("The **backup interval is** currently turned **off**.\n"
                              f"Turn it on with `{ctx.bot.prefix}backup interval on 24h`.")
@@ -420,6 +438,13 @@ class Backups(wkr.Module):
                         "name": "Next Backup",
                         "value": utils.datetime_to_string(interval["next"]) + " UTC",
                         "inline": False
+                    },
+                    {
+                        "name": "Retention",
+                        "value": ", ".join(
+                            f"{count} {name}" for name, count in retention.get_retention(interval).items()
+                        ),
+                        "inline": False
                     }
                 ]
             })
@@ -464,9 +489,12 @@ class Backups(wkr.Module):
 
         now = datetime.utcnow()
         td = timedelta(hours=hours)
-        await ctx.bot.db.intervals.update_one({"guild": ctx.guild_id, "user": ctx.author.id}, {"$set": {
-            "guild": ctx.guild_id,
-            "user": ctx.author.id,
+        await ctx.bot.db.intervals.update_one({
+            "guild": utils.snowflake_filter(ctx.guild_id),
+            "user": utils.snowflake_filter(ctx.author.id)
+        }, {"$set": {
+            "guild": utils.snowflake(ctx.guild_id),
+            "user": utils.snowflake(ctx.author.id),
             "last": now,
             "next": now,
             "interval": hours
@@ -488,7 +516,10 @@ class Backups(wkr.Module):
 
         ```{b.prefix}backup interval off```
         """
-        result = await ctx.bot.db.intervals.delete_one({"guild": ctx.guild_id, "user": ctx.author.id})
+        result = await ctx.bot.db.intervals.delete_one({
+            "guild": utils.snowflake_filter(ctx.guild_id),
+            "user": utils.snowflake_filter(ctx.author.id)
+        })
         if result.deleted_count > 0:
             await ctx.bot.create_audit_log(utils.AuditLogType.BACKUP_INTERVAL_DISABLE, [ctx.guild_id], ctx.author.id)
             raise ctx.f.SUCCESS("Successfully **disabled the backup interval**.")
@@ -496,11 +527,89 @@ class Backups(wkr.Module):
         else:
             raise ctx.f.ERROR(f"The backup interval is not enabled.")
 
+    @interval.command(aliases=["keep"])
+    @wkr.cooldown(1, 10, bucket=wkr.CooldownType.GUILD)
+    async def retention(self, ctx, daily: int, weekly: int = 0, monthly: int = 0):
+        """
+        Choose how many automated backups are kept for this server
+
+        The newest backup of each of the most recent days, weeks and months is kept.
+
+
+        __Arguments__
+
+        **daily**: The number of daily backups to keep (max 7)
+        **weekly**: The number of weekly backups to keep (max 4)
+        **monthly**: The number of monthly backups to keep (max 3)
+
+
+        __Examples__
+
+        One week of daily backups and 3 monthly ones: ```{b.prefix}backup interval retention 7 0 3```
+        """
+        values = {"daily": daily, "weekly": weekly, "monthly": monthly}
+        for name, value in values.items():
+            if not 0 <= value <= retention.MAX_RETENTION[name]:
+                raise ctx.f.ERROR(f"You can keep **between 0 and {retention.MAX_RETENTION[name]} {name}** backups.")
+
+        if sum(values.values()) == 0:
+            raise ctx.f.ERROR("You have to **keep at least one** backup.")
+
+        result = await ctx.bot.db.intervals.update_one({
+            "guild": utils.snowflake_filter(ctx.guild_id),
+            "user": utils.snowflake_filter(ctx.author.id)
+        }, {"$set": {"retention": values}})
+        if result.matched_count == 0:
+            raise ctx.f.ERROR(f"The backup interval is not enabled.\n"
+                              f"Turn it on with `{ctx.bot.prefix}backup interval on 24h`.")
+
+        raise ctx.f.SUCCESS(f"Successfully **changed the retention** to {daily} daily, {weekly} weekly and "
+                            f"{monthly} monthly backups.")
+
+    async def _prune_interval_backups(self, intervals):
+        """
+        Removes the interval backups that fall out of the retention with a single query and delete
+        """
+        if not intervals:
+            return
+
+        policies = {
+            (utils.snowflake(interval["user"]), utils.snowflake(interval["guild"])): retention.get_retention(interval)
+            for interval in intervals
+        }
+        existing = self.bot.db.backups.find(
+            {
+                "interval": True,
+                "$or": [
+                    {"creator": utils.snowflake_filter(user_id), "data.id": utils.snowflake_filter(guild_id)}
+                    for user_id, guild_id in policies.keys()
+                ]
+            },
+            projection={"_id": True, "creator": True, "data.id": True, "timestamp": True},
+            sort=[("timestamp", pymongo.DESCENDING)]
+        )
+        generations = {}
+        async for backup in existing:
+            key = (utils.snowflake(backup["creator"]), utils.snowflake(backup["data"]["id"]))
+            generations.setdefault(key, []).append(backup)
+
+        pruned = []
+        for key, backups in generations.items():
+            pruned.extend(retention.select_pruned(backups, policies[key]))
+
+        if not pruned:
+            return
+
+        # Interval backups don't count towards the backup limit, so there are no counters to adjust
+        await self.bot.db.backups.delete_many({"_id": {"$in": [backup["_id"] for backup in pruned]}})
+
     @wkr.Module.task(minutes=random.randint(5, 15))
     async def interval_task(self):
-        semaphore = asyncio.Semaphore(value=1)
+        controller = self.bot.traffic.controller("interval")
 
         async def _run_interval_backups(interval):
+            traffic.current_lane.set("bulk")
+            error = None
             try:
                 try:
                     guild = await self.bot.fetch_full_guild(interval["guild"])
@@ -511,23 +620,101 @@ class Backups(wkr.Module):
                 backup = BackupSaver(self.bot, guild)
                 await backup.save()
 
-                await self.bot.db.backups.delete_one(
-                    {"creator": interval["user"], "data.id": guild.id, "interval": True})
                 await self.bot.db.backups.insert_one({
                     "_id": utils.unique_id(),
-                    "creator": interval["user"],
+                    "creator": utils.snowflake(interval["user"]),
                     "timestamp": datetime.utcnow(),
                     "interval": True,
+                    "version": migrations.CURRENT_VERSION,
+                    "sizes": backup.sizes,
                     "data": backup.data
                 })
+                processed.append(interval)
+            except Exception as e:
+                error = e
+                raise
             finally:
-                semaphore.release()
-
-        to_backup = self.bot.db.intervals.find({"next": {"$lt": datetime.utcnow()}})
-        async for interval in to_backup:
-            await semaphore.acquire()
-            self.bot.schedule(_run_interval_backups(interval))
-            await self.bot.db.intervals.update_one({"_id": interval["_id"]}, {"$set": {
-                "next": interval["next"] + timedelta(hours=interval["interval"]),
-                "last": datetime.utcnow()
-            }})
+                await controller.release(error)
+
+        processed = []
+        tasks = []
+        now = datetime.utcnow()
+        while True:
+            # Claiming moves next forward, so every due interval is only picked up by one worker
+            interval = await self.bot.db.intervals.find_one_and_update(
+                {"next": {"$lt": now}, "last": {"$not": {"$gte": now}}},
+                [{"$set": {
+                    "next": {"$add": ["$next", {"$multiply": ["$interval", 60 * 60 * 1000]}]},
+                    "last": now
+                }}]
+            )
+            if interval is None:
+                break
+
+            await controller.acquire()
+            tasks.append(self.bot.schedule(_run_interval_backups(interval)))
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._prune_interval_backups(processed)
+
+    @wkr.Module.task(hours=6)
+    async def reconcile_task(self):
+        # A full aggregation, one worker is enough
+        if await utils.acquire_lease(self.bot.redis, "reconcile_task", 5 * 60 * 60):
+            await quotas.reconcile_backup_counts(self.bot.db)
+
+    @wkr.Module.task(minutes=10)
+    async def upgrade_task(self):
+        """
+        Rewrites outdated documents in the background, this mainly converts string snowflakes to int64
+        """
+        if not await utils.acquire_lease(self.bot.redis, "upgrade_task", 9 * 60):
+            return
+
+        query = {"$or": [{"version": {"$exists": False}}, {"version": {"$lt": migrations.CURRENT_VERSION}}]}
+        checkpoint = await self.bot.db.migrations.find_one({"_id": UPGRADE_CHECKPOINT_ID})
+        if checkpoint is not None:
+            query["_id"] = {"$gt": checkpoint["last_id"]}
+
+        outdated = self.bot.db.backups.find(
+            query,
+            projection={"_id": True, "version": True, "backup.id": True},
+            sort=[("_id", pymongo.ASCENDING)],
+            limit=UPGRADE_BATCH_SIZE
+        )
+        count = 0
+        last_id = None
+        async for backup in outdated:
+            count += 1
+            last_id = backup["_id"]
+            try:
+                await migrations.ensure_upgraded(self.bot.db, backup)
+            except Exception:
+                # A broken document must not block the ones after it
+                await self.bot.db.migration_failures.replace_one(
+                    {"_id": backup["_id"]},
+                    {"_id": backup["_id"], "error": traceback.format_exc(), "timestamp": datetime.utcnow()},
+                    upsert=True
+                )
+
+        if count < UPGRADE_BATCH_SIZE:
+            # Start over on the next run, failed documents are retried then
+            await self.bot.db.migrations.delete_one({"_id": UPGRADE_CHECKPOINT_ID})
+
+        else:
+            await self.bot.db.migrations.update_one(
+                {"_id": UPGRADE_CHECKPOINT_ID},
+                {"$set": {"last_id": last_id}},
+                upsert=True
+            )
+
+        snowflake_fields = {
+            "intervals": ("guild", "user"),
+            "id_translators": ("source_id", "target_id")
+        }
+        for collection, fields in snowflake_fields.items():
+            for field in fields:
+                await self.bot.db[collection].update_many(
+                    {field: {"$type": "string"}},
+                    [{"$set": {field: {"$toLong": f"${field}"}}}]
+                )
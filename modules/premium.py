@@ -1,5 +1,12 @@
 import xenon_worker as wkr
 
+import utils
+import checks
+import messages
+import migrations
+import replay
+from backups import BackupSaver, prepare_copy, confirm_load, run_load
+
 
 class Premium(wkr.Module):
     @wkr.Module.command(aliases=("chatlog", "chatlogs"))
@@ -10,8 +17,66 @@ class Premium(wkr.Module):
         
         You can find more help on the [wiki](https://wiki.xenon.bot/chatlog)
         """
-        await ctx.f_send("This command can **only** be used with **Xenon Premium**.", f=ctx.f.INFO)
-        await ctx.invoke("premium")
+        await ctx.invoke("help chatlog")
+
+    @chatlog.command(aliases=("l",))
+    @wkr.guild_only
+    @checks.has_permissions_level()
+    @wkr.bot_has_permissions(manage_webhooks=True)
+    @wkr.cooldown(1, 60, bucket=wkr.CooldownType.GUILD)
+    async def load(self, ctx, backup_id: str.lower):
+        """
+        Load the messages of a backup into the channels that were created by loading it on this server
+
+
+        __Arguments__
+
+        **backup_id**: The id of the backup
+
+
+        __Examples__
+
+        ```{b.prefix}chatlog load oj1xky11871fzrbu```
+        """
+        backup_d = await ctx.client.db.backups.find_one(
+            {"_id": backup_id, "creator": utils.snowflake_filter(ctx.author.id)},
+            projection={"data.id": True, "version": True}
+        )
+        # Older backups keep their messages inside of the document
+        backup_d = await migrations.ensure_upgraded(ctx.client.db, backup_d)
+        if backup_d is None:
+            raise ctx.f.ERROR(f"You have **no backup** with the id `{backup_id.upper()}`.")
+
+        translator = await ctx.bot.translators.get(backup_d["data"]["id"], ctx.guild_id)
+        channels = []
+        for channel_id in await messages.channels(ctx.client.db, backup_id):
+            target_id = translator.get(utils.snowflake(channel_id))
+            if target_id is not None:
+                channels.append((target_id, messages.iter_messages(ctx.client.db, backup_id, channel_id)))
+
+        if not channels:
+            raise ctx.f.ERROR("There are **no messages** for the channels of this server in the backup.\n"
+                              "You have to **load the backup** on this server first.")
+
+        status_msg = await ctx.f_send(f"**Loading messages** into **{len(channels)} channels** ...", f=ctx.f.WORKING)
+        sent, failed = await replay.replay(ctx.client, channels)
+
+        text = f"Successfully **loaded {sent} messages** into **{len(channels)} channels**."
+        if failed:
+            text += f"\n**{failed} messages** couldn't be loaded."
+
+        try:
+            await ctx.client.edit_message(status_msg, embed=ctx.f.format(text, f=ctx.f.SUCCESS)["embed"])
+        except wkr.DiscordException:
+            # The status message was deleted in the meantime
+            pass
+
+        await ctx.bot.create_audit_log(
+            utils.AuditLogType.CHATLOG_LOAD,
+            [ctx.guild_id],
+            ctx.author.id,
+            extra={"backup_id": backup_id, "channels": len(channels), "sent": sent, "failed": failed}
+        )
 
     @wkr.Module.command()
     @wkr.cooldown(1, 3, bucket=wkr.CooldownType.AUTHOR)
@@ -25,10 +90,65 @@ class Premium(wkr.Module):
         await ctx.invoke("premium")
 
     @wkr.Module.command()
-    @wkr.cooldown(1, 3, bucket=wkr.CooldownType.AUTHOR)
-    async def copy(self, ctx):
+    @wkr.guild_only
+    @checks.has_permissions_level(destructive=True)
+    @wkr.bot_has_permissions(administrator=True)
+    @wkr.cooldown(1, 60, bucket=wkr.CooldownType.GUILD)
+    async def copy(self, ctx, source_id, *options):
         """
         Copy servers without creating a backup
+
+        The source server is saved and loaded on this server at the same time, nothing is stored.
+        Only the owner of the source server can copy it.
+
+
+        __Arguments__
+
+        **source_id**: The id of the server to copy
+        **options**: A list of options (See examples)
+
+
+        __Examples__
+
+        Default options: ```{b.prefix}copy 410488579140354049```
+        Only roles: ```{b.prefix}copy 410488579140354049 !* roles```
         """
-        await ctx.f_send("This command can **only** be used with **Xenon Premium**.", f=ctx.f.INFO)
-        await ctx.invoke("premium")
+        if not source_id.isdigit():
+            raise ctx.f.ERROR(f"`{source_id}` is **not a valid server id**.")
+
+        if utils.snowflake(source_id) == utils.snowflake(ctx.guild_id):
+            raise ctx.f.ERROR("You **can't copy** a server **to itself**.")
+
+        try:
+            source = await ctx.client.fetch_full_guild(source_id)
+        except (wkr.NotFound, wkr.Forbidden):
+            raise ctx.f.ERROR(f"The server with the id `{source_id}` **doesn't exist** or I'm **not a member** of it.")
+
+        saver = BackupSaver(ctx.client, source, trim_order=())
+        if saver.data.get("owner_id") != utils.snowflake(ctx.author.id):
+            raise ctx.f.ERROR("You need to be the **owner of the source server** to copy it.")
+
+        warning_text = f"Are you sure that you want to copy the server `{saver.data['name']}` to this server?\n" \
+                       f"Please put the managed role called `{ctx.bot.user.name}` above all other " \
+                       f"roles before clicking the ✅ reaction.\n\n" \
+                       "__**All channels and roles will get replaced!**__\n\n" \
+                       "*Also keep in mind that you can only load up to 250 roles per 48 hours.*"
+        loader = await confirm_load(ctx, prepare_copy(
+            ctx.client,
+            saver,
+            ctx.fetch_full_guild(),
+            utils.backup_options(options),
+            reason="Server copied by " + str(ctx.author)
+        ), warning_text)
+        if loader is None:
+            return
+
+        await run_load(ctx, loader, {
+            "id": ctx.guild_id,
+            "type": "copy",
+            "user_id": ctx.author.id,
+            "source_id": saver.data["id"]
+        }, utils.AuditLogType.COPY, guild_ids=[source.id, ctx.guild_id], extra={
+            "source": source.id,
+            "target": ctx.guild_id
+        })
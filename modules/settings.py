@@ -1,7 +1,7 @@
 import xenon_worker as wkr
-from datetime import datetime, timedelta
 
 import checks
+import utils
 
 PERMISSION_DESCRIPTIONS = {
     checks.PermissionLevels.ADMIN_ONY: "Server admins can create backups, enable the backup interval and "
@@ -13,14 +13,6 @@ PERMISSION_DESCRIPTIONS = {
 
 
 class Settings(wkr.Module):
-    @wkr.Module.task(hours=1)
-    async def audit_log_retention(self):
-        await self.bot.db.audit_logs.delete_many({
-            "timestamp": {
-                "$lte": datetime.utcnow() - timedelta(days=365)
-            }
-        })
-
     @wkr.Module.command(aliases=("set",))
     @wkr.guild_only
     @wkr.is_owner
@@ -99,7 +91,10 @@ class Settings(wkr.Module):
 
             elif level == "owner":
                 conf_level = checks.PermissionLevels.OWNER_ONLY
-                await ctx.bot.db.intervals.delete_many({"guild": ctx.guild_id, "user": {"$ne": ctx.author.id}})
+                await ctx.bot.db.intervals.delete_many({
+                    "guild": utils.snowflake_filter(ctx.guild_id),
+                    "user": {"$nin": utils.snowflake_filter(ctx.author.id)["$in"]}
+                })
                 await ctx.f_send("__Changed the permissions level for this server to:__\n"
                                  f"**{PERMISSION_DESCRIPTIONS[conf_level]}**.\n\n"
                                  f"*Use `{ctx.bot.prefix}help settings permissions` to get more info.*",
@@ -1,12 +1,10 @@
 import xenon_worker as wkr
 import utils
-import asyncio
 import pymongo
 import pymongo.errors
-import msgpack
 
 import checks
-from backups import BackupLoader
+from backups import prepare_loader, confirm_load, run_load
 
 
 class TemplateListMenu(wkr.ListMenu):
@@ -124,79 +122,30 @@ class Templates(wkr.Module):
         if template is None:
             raise ctx.f.ERROR(f"There is **no template** with the name `{name}`.")
 
-        warning_msg = await ctx.f_send("Are you sure that you want to load this template?\n"
-                                       f"Please put the managed role called `{ctx.bot.user.name}` above all other "
-                                       f"roles before clicking the ✅ reaction.\n\n"
-                                       "__**All channels and roles will get replaced!**__\n\n"
-                                       "*Also keep in mind that you can only load up to 250 roles per day.*",
-                                       f=ctx.f.WARNING)
-
-        reactions = ("✅", "❌")
-        for reaction in reactions:
-            await ctx.client.add_reaction(warning_msg, reaction)
-
-        try:
-            data, = await ctx.client.wait_for(
-                "message_reaction_add",
-                ctx.shard_id,
-                check=lambda d: d["message_id"] == warning_msg.id and
-                                d["user_id"] == ctx.author.id and
-                                d["emoji"]["name"] in reactions,
-                timeout=60
-            )
-        except asyncio.TimeoutError:
-            await ctx.client.delete_message(warning_msg)
-            return
-
-        await ctx.client.delete_message(warning_msg)
-        if data["emoji"]["name"] != "✅":
-            return
-
-        guild = await ctx.fetch_full_guild()
-        backup = BackupLoader(ctx.client, guild, template["data"], reason="Template loaded by " + str(ctx.author))
-
         options = list(options)
         options.extend(["!settings", "!members"])
-        await self.client.redis.publish("loaders:start", msgpack.packb({
+        warning_text = "Are you sure that you want to load this template?\n" \
+                       f"Please put the managed role called `{ctx.bot.user.name}` above all other " \
+                       f"roles before clicking the ✅ reaction.\n\n" \
+                       "__**All channels and roles will get replaced!**__\n\n" \
+                       "*Also keep in mind that you can only load up to 250 roles per day.*"
+        backup = await confirm_load(ctx, prepare_loader(
+            ctx.client,
+            ctx.fetch_full_guild(),
+            template["data"],
+            utils.backup_options(options),
+            reason="Template loaded by " + str(ctx.author)
+        ), warning_text)
+        if backup is None:
+            return
+
+        await run_load(ctx, backup, {
             "id": ctx.guild_id,
             "type": "template",
             "user_id": ctx.author.id,
             "source_id": str(backup.data["id"]),
             "template_id": name.strip("/").split("/")[-1]
-        }))
-        try:
-            await backup.load(**utils.backup_options(options))
-
-            unpacked_ids = {
-                f"ids.{s}": t
-                for s, t in backup.id_translator.items()
-            }
-            await ctx.bot.db.id_translators.update_one(
-                {
-                    "target_id": ctx.guild_id,
-                    "source_id": backup.data["id"],
-                },
-                {
-                    "$set": {
-                        "target_id": ctx.guild_id,
-                        "source_id": backup.data["id"],
-                        **unpacked_ids
-                    },
-                    "$addToSet": {
-                        "loaders": ctx.author.id
-                    }
-                },
-                upsert=True
-            )
-        finally:
-            await self.client.redis.publish("loaders:done", msgpack.packb({
-                "id": ctx.guild_id,
-                "type": "template",
-                "user_id": ctx.author.id,
-                "source_id": str(backup.data["id"]),
-                "template_id": name.strip("/").split("/")[-1]
-            }))
-            await ctx.bot.create_audit_log(utils.AuditLogType.TEMPLATE_LOAD, [ctx.guild_id], ctx.author.id)
+        }, utils.AuditLogType.TEMPLATE_LOAD)
 
     @template.command(aliases=("ls", "search", "s"))
     @wkr.cooldown(1, 10)
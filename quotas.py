@@ -0,0 +1,139 @@
+import pymongo
+from pymongo import errors as mongoerrors
+from datetime import datetime, timedelta
+import time
+
+import utils
+
+# Discord only allows 250 role creations per guild in 48 hours
+ROLE_CREATE_LIMIT = 250
+ROLE_CREATE_PERIOD = 48 * 60 * 60
+
+# Interval backups are kept by the retention policy and don't count towards the backup limit
+COUNTED_BACKUPS = {"interval": {"$ne": True}}
+# Counters that changed within this time might have reservations of backups that aren't inserted yet
+RECONCILE_GRACE = timedelta(minutes=10)
+
+
+async def _seed_backup_count(db, user_id):
+    """
+    Initializes the counter of a user from the real count, this only happens once per user
+    """
+    count = await db.backups.count_documents({"creator": utils.snowflake_filter(user_id), **COUNTED_BACKUPS})
+    try:
+        await db.backup_counts.update_one({"_id": user_id}, {"$setOnInsert": {"count": count, "updated": datetime.utcnow()}}, upsert=True)
+    except mongoerrors.DuplicateKeyError:
+        # Another worker seeded it in the meantime
+        pass
+
+
+async def reserve_backup(db, user_id, limit):
+    """
+    Atomically increments the backup count of a user if it's below the limit
+
+    Returns the new count or None if the limit is reached
+    """
+    user_id = utils.snowflake(user_id)
+    for _ in range(2):
+        counter = await db.backup_counts.find_one_and_update(
+            {"_id": user_id, "count": {"$lt": limit}},
+            {"$inc": {"count": 1}, "$set": {"updated": datetime.utcnow()}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if counter is not None:
+            return counter["count"]
+
+        if await db.backup_counts.count_documents({"_id": user_id}, limit=1) > 0:
+            return None
+
+        await _seed_backup_count(db, user_id)
+
+    return None
+
+
+async def change_backup_count(db, user_id, amount):
+    if amount == 0:
+        return
+
+    # Users without a counter get it seeded with the real count on their next create
+    await db.backup_counts.update_one(
+        {"_id": utils.snowflake(user_id)},
+        {"$inc": {"count": amount}, "$set": {"updated": datetime.utcnow()}}
+    )
+
+
+async def reconcile_backup_counts(db, user_ids=None):
+    """
+    Corrects counters that drifted from the real number of backups
+    """
+    match = dict(COUNTED_BACKUPS)
+    # Recently changed counters are left alone, their reservations may not be inserted yet
+    counter_filter = {"updated": {"$not": {"$gte": datetime.utcnow() - RECONCILE_GRACE}}}
+    if user_ids is not None:
+        user_ids = [utils.snowflake(user_id) for user_id in user_ids]
+        match["creator"] = {"$in": user_ids + [str(user_id) for user_id in user_ids]}
+        counter_filter["_id"] = {"$in": user_ids}
+
+    pipeline = [{"$match": match}, {"$group": {"_id": "$creator", "count": {"$sum": 1}}}]
+
+    counts = {}
+    async for result in db.backups.aggregate(pipeline, allowDiskUse=True):
+        # Legacy backups might still use string ids
+        user_id = utils.snowflake(result["_id"])
+        counts[user_id] = counts.get(user_id, 0) + result["count"]
+
+    updates = []
+    async for counter in db.backup_counts.find(counter_filter):
+        count = counts.get(counter["_id"], 0)
+        if counter["count"] != count:
+            # Only applies if no create or delete happened in the meantime
+            updates.append(pymongo.UpdateOne(
+                {"_id": counter["_id"], "count": counter["count"], "updated": counter.get("updated")},
+                {"$set": {"count": count}}
+            ))
+
+    if updates:
+        await db.backup_counts.bulk_write(updates, ordered=False)
+
+
+def _role_ledger_key(guild_id):
+    return f"role_creates:{guild_id}"
+
+
+async def remaining_role_creates(redis, guild_id):
+    """
+    Returns how many roles can still be created in a guild according to the rolling ledger
+    """
+    key = _role_ledger_key(guild_id)
+    await redis.zremrangebyscore(key, max=time.time() - ROLE_CREATE_PERIOD)
+    return max(ROLE_CREATE_LIMIT - await redis.zcard(key), 0)
+
+
+async def record_role_creates(redis, guild_id, role_ids):
+    """
+    Adds created roles to the ledger of a guild, entries expire after the rolling period
+    """
+    if not role_ids:
+        return
+
+    key = _role_ledger_key(guild_id)
+    now = time.time()
+    pairs = []
+    for role_id in role_ids:
+        pairs.extend((now, str(role_id)))
+
+    tr = redis.multi_exec()
+    tr.zadd(key, *pairs)
+    tr.expire(key, ROLE_CREATE_PERIOD)
+    await tr.execute()
+
+
+async def exhaust_role_creates(redis, guild_id):
+    """
+    Fills the ledger of a guild after discord refused to create more roles
+
+    This happens if roles were created without the ledger knowing about it, e.g. by other bots.
+    """
+    remaining = await remaining_role_creates(redis, guild_id)
+    now = time.time()
+    await record_role_creates(redis, guild_id, [f"unknown-{now}-{i}" for i in range(remaining)])
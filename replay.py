@@ -0,0 +1,248 @@
+import xenon_worker as wkr
+import aiohttp
+import asyncio
+import time
+
+DISCORD_API = "https://discord.com/api/v8"
+AVATAR_URL = "https://cdn.discordapp.com/avatars/{id}/{avatar}.png"
+
+WEBHOOK_NAME = "Xenon Replay"
+WEBHOOKS_PER_CHANNEL = 3
+CHANNEL_CONCURRENCY = 5
+MAX_RETRIES = 5
+
+
+class Bucket:
+    """
+    The rate limit of a single webhook, updated from the headers of every response
+    """
+    def __init__(self):
+        self.remaining = 1
+        self.reset_at = 0
+
+    @property
+    def available_at(self):
+        return 0 if self.remaining > 0 else self.reset_at
+
+    def update(self, headers):
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset_after = headers.get("X-RateLimit-Reset-After")
+        if remaining is not None:
+            self.remaining = int(remaining)
+
+        if reset_after is not None:
+            self.reset_at = time.monotonic() + float(reset_after)
+
+    def block(self, retry_after):
+        self.remaining = 0
+        self.reset_at = time.monotonic() + retry_after
+
+    def take(self):
+        if self.remaining <= 0 and time.monotonic() >= self.reset_at:
+            # The bucket was reset, the real remaining count comes with the next response
+            self.remaining = 1
+
+        self.remaining -= 1
+
+
+class Webhook:
+    def __init__(self, id, token, created=False):
+        self.id = id
+        self.token = token
+        self.created = created
+        self.bucket = Bucket()
+
+
+class WebhookPool:
+    """
+    The webhooks of a single channel
+
+    Messages of a channel are sent one after another to keep their order,
+    the pool always picks the webhook that can send the earliest.
+    """
+    def __init__(self, channel_id, webhooks):
+        self.channel_id = channel_id
+        self.webhooks = webhooks
+
+    async def acquire(self):
+        webhook = min(self.webhooks, key=lambda w: w.bucket.available_at)
+        delay = webhook.bucket.available_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        webhook.bucket.take()
+        return webhook
+
+    def block(self, retry_after):
+        for webhook in self.webhooks:
+            webhook.bucket.block(retry_after)
+
+
+async def create_pool(client, channel_id, size=WEBHOOKS_PER_CHANNEL):
+    """
+    Reuses the replay webhooks of a channel and creates the missing ones
+    """
+    existing = await client.http.request(wkr.Route("GET", f"/channels/{channel_id}/webhooks"))
+    webhooks = [
+        Webhook(w["id"], w["token"])
+        for w in existing
+        if w.get("name") == WEBHOOK_NAME and w.get("token")
+    ][:size]
+
+    while len(webhooks) < size:
+        try:
+            data = await client.http.request(
+                wkr.Route("POST", f"/channels/{channel_id}/webhooks"),
+                json={"name": WEBHOOK_NAME}
+            )
+        except wkr.DiscordException:
+            # Channels have a webhook limit, we work with what we got
+            if webhooks:
+                break
+
+            raise
+
+        webhooks.append(Webhook(data["id"], data["token"], created=True))
+
+    return WebhookPool(channel_id, webhooks)
+
+
+async def delete_pool(client, pool):
+    for webhook in pool.webhooks:
+        if webhook.created:
+            try:
+                await client.http.request(wkr.Route("DELETE", f"/webhooks/{webhook.id}"))
+            except wkr.DiscordException:
+                pass
+
+
+def message_payload(message):
+    """
+    Turns a message of a backup into the payload of a webhook execution, returns None if there is nothing to send
+    """
+    content = message.get("content") or ""
+    attachments = [a["url"] for a in message.get("attachments", [])]
+    if attachments:
+        content = "\n".join([content, *attachments]).strip()
+
+    embeds = message.get("embeds", [])[:10]
+    if not content and not embeds:
+        return None
+
+    author = message.get("author", {})
+    payload = {
+        "content": content[:2000],
+        "embeds": embeds,
+        "username": (author.get("username") or "Unknown")[:80],
+        "allowed_mentions": {"parse": []}
+    }
+    if author.get("avatar"):
+        payload["avatar_url"] = AVATAR_URL.format(**author)
+
+    return payload
+
+
+class ReplayEngine:
+    """
+    Replays the messages of multiple channels through webhooks
+
+    Channels are replayed in parallel, the messages of each channel in their original order.
+    The api base can be pointed to a local stand-in for discord.
+    """
+    def __init__(self, session, api_base=DISCORD_API, channel_concurrency=CHANNEL_CONCURRENCY):
+        self.session = session
+        self.api_base = api_base
+        self.channel_concurrency = channel_concurrency
+
+        self.sent = 0
+        self.failed = 0
+
+    async def execute(self, pool, payload):
+        # Rate limits only delay a message, they don't count as failed attempts
+        attempts = 0
+        while attempts < MAX_RETRIES:
+            webhook = await pool.acquire()
+            url = f"{self.api_base}/webhooks/{webhook.id}/{webhook.token}"
+            try:
+                async with self.session.post(url, json=payload, params={"wait": "true"}) as resp:
+                    webhook.bucket.update(resp.headers)
+                    if resp.status == 429:
+                        data = await resp.json()
+                        retry_after = float(data.get("retry_after", 1))
+                        if resp.headers.get("X-RateLimit-Scope") in ("shared", "global"):
+                            # The limit of the channel applies to all webhooks in it
+                            pool.block(retry_after)
+
+                        else:
+                            webhook.bucket.block(retry_after)
+
+                        continue
+
+                    if resp.status >= 500:
+                        attempts += 1
+                        await asyncio.sleep(1)
+                        continue
+
+                    # Invalid messages are skipped, there is no point in retrying them
+                    return resp.status < 400
+
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # Connection errors are treated like server errors
+                attempts += 1
+                await asyncio.sleep(1)
+
+        return False
+
+    async def replay_channel(self, pool, messages):
+        async for message in messages:
+            payload = message_payload(message)
+            if payload is None:
+                continue
+
+            if await self.execute(pool, payload):
+                self.sent += 1
+
+            else:
+                self.failed += 1
+
+    async def replay(self, channels):
+        """
+        channels is a list of (pool, messages) pairs, messages is an async iterable
+        """
+        semaphore = asyncio.Semaphore(self.channel_concurrency)
+
+        async def _replay_channel(pool, messages):
+            async with semaphore:
+                await self.replay_channel(pool, messages)
+
+        tasks = [asyncio.ensure_future(_replay_channel(pool, messages)) for pool, messages in channels]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # The webhooks are deleted afterwards, nothing may still be sending through them
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def replay(client, channels, api_base=DISCORD_API):
+    """
+    Replays messages into the target channels, channels is a list of (target channel id, messages) pairs
+
+    Returns the number of sent and failed messages.
+    """
+    pools = []
+    try:
+        for channel_id, _ in channels:
+            pools.append(await create_pool(client, channel_id))
+
+        async with aiohttp.ClientSession() as session:
+            engine = ReplayEngine(session, api_base=api_base)
+            await engine.replay(list(zip(pools, [messages for _, messages in channels])))
+
+        return engine.sent, engine.failed
+
+    finally:
+        for pool in pools:
+            await delete_pool(client, pool)
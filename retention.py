@@ -0,0 +1,50 @@
+DEFAULT_RETENTION = {
+    "daily": 1,
+    "weekly": 0,
+    "monthly": 0
+}
+
+MAX_RETENTION = {
+    "daily": 7,
+    "weekly": 4,
+    "monthly": 3
+}
+
+PERIODS = {
+    "daily": lambda dt: (dt.year, dt.month, dt.day),
+    "weekly": lambda dt: tuple(dt.isocalendar()[:2]),
+    "monthly": lambda dt: (dt.year, dt.month)
+}
+
+
+def get_retention(interval):
+    return {**DEFAULT_RETENTION, **interval.get("retention", {})}
+
+
+def select_kept(backups, retention):
+    """
+    Returns the ids of the backups that are kept, this is the newest backup of each of the most recent periods
+
+    The backups must be sorted from the newest to the oldest
+    """
+    kept = set()
+    for name, period in PERIODS.items():
+        count = retention.get(name, 0)
+        seen = set()
+        for backup in backups:
+            if len(seen) >= count:
+                break
+
+            key = period(backup["timestamp"])
+            if key in seen:
+                continue
+
+            seen.add(key)
+            kept.add(backup["_id"])
+
+    return kept
+
+
+def select_pruned(backups, retention):
+    kept = select_kept(backups, retention)
+    return [backup for backup in backups if backup["_id"] not in kept]
@@ -0,0 +1,98 @@
+from os import environ as env
+import asyncio
+import msgpack
+
+# Commands that make a lot of requests or run for a long time, everything else is light
+HEAVY_COMMANDS = {
+    ("backup", "create"),
+    ("backup", "load"),
+    ("template", "load"),
+    ("chatlog",),
+    ("copy",),
+    ("sync",)
+}
+COMMAND_ALIASES = {
+    "backups": "backup",
+    "bu": "backup",
+    "temp": "template",
+    "tpl": "template",
+    "chatlogs": "chatlog",
+    "c": "create",
+    "l": "load"
+}
+
+LANES = ("heavy", "light")
+# Default prefetch and number of worker processes per lane, can be overwritten with <LANE>_PREFETCH and <LANE>_WORKERS
+LANE_SETTINGS = {
+    "heavy": {"prefetch": 1, "workers": 1},
+    "light": {"prefetch": 20, "workers": 1}
+}
+
+
+def lane_settings(lane):
+    settings = dict(LANE_SETTINGS[lane])
+    for key in settings.keys():
+        value = env.get(f"{lane.upper()}_{key.upper()}")
+        if value:
+            settings[key] = int(value)
+
+    return settings
+
+
+def queue_name(shared_queue, lane):
+    return f"{shared_queue}.{lane}"
+
+
+def classify(content, prefix):
+    """
+    Returns the lane of a message based on the command it invokes
+    """
+    if not content or not content.startswith(prefix):
+        return "light"
+
+    parts = [COMMAND_ALIASES.get(part, part) for part in content[len(prefix):].lower().split()[:2]]
+    for length in (1, 2):
+        if tuple(parts[:length]) in HEAVY_COMMANDS:
+            return "heavy"
+
+    return "light"
+
+
+def classify_event(body, prefix):
+    try:
+        event = msgpack.unpackb(body, raw=False)
+        if event.get("t") != "MESSAGE_CREATE":
+            return "light"
+
+        return classify(event["d"].get("content"), prefix)
+    except Exception:
+        # Unknown events are never dropped
+        return "light"
+
+
+async def run_router(rabbit_url, shared_queue, prefix):
+    """
+    Moves the events from the shared queue to the queue of their lane
+    """
+    # Only the router talks to rabbitmq directly, the workers use the connection of the bot
+    import aio_pika
+
+    connection = await aio_pika.connect_robust(rabbit_url)
+    channel = await connection.channel()
+    await channel.set_qos(prefetch_count=100)
+    for lane in LANES:
+        await channel.declare_queue(queue_name(shared_queue, lane), durable=True)
+
+    queue = await channel.declare_queue(shared_queue, durable=True)
+    async with queue.iterator() as events:
+        async for event in events:
+            async with event.process():
+                lane = classify_event(event.body, prefix)
+                await channel.default_exchange.publish(
+                    aio_pika.Message(event.body, headers=event.headers, delivery_mode=event.delivery_mode),
+                    routing_key=queue_name(shared_queue, lane)
+                )
+
+
+def start_router(rabbit_url, shared_queue, prefix):
+    asyncio.get_event_loop().run_until_complete(run_router(rabbit_url, shared_queue, prefix))
@@ -0,0 +1,296 @@
+import xenon_worker as wkr
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from collections import deque
+import asyncio
+import aiohttp
+import time
+
+import utils
+
+# Window limits per route class, the window is the number of calls that are allowed to be in flight
+ROUTE_LIMITS = {
+    "guild": (1, 1, 2),
+    "roles": (1, 1, 4),
+    "channels": (2, 1, 8),
+    "bans": (2, 1, 16),
+    "interval": (1, 1, 8)
+}
+DEFAULT_LIMITS = (1, 1, 4)
+
+# The lane of the requests made by the current task, loaders and interval backups switch to the bulk lane
+current_lane = ContextVar("lane", default="interactive")
+
+# The permit of the current task, the responses of its requests are reported to its controller
+current_permit = ContextVar("permit", default=None)
+
+# Multiple 429s in a short time are usually caused by the same congestion
+DECREASE_COOLDOWN = 1
+
+
+def _headers(error):
+    response = getattr(error, "response", None)
+    return getattr(response, "headers", None) or {}
+
+
+def is_rate_limited(error):
+    return isinstance(error, wkr.DiscordException) and getattr(error, "status", None) == 429
+
+
+class AIMDController:
+    """
+    Limits the number of in-flight calls of a route class
+
+    The window grows by one for every window of successful calls and is halved when discord responds with a 429.
+    """
+    def __init__(self, initial=1, minimum=1, maximum=4, increase=1, decrease=0.5):
+        self.window = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+
+        self.in_flight = 0
+        self.successes = 0
+        self.rate_limits = 0
+        self._last_decrease = 0
+        self._condition = None
+
+    @utils.loop_bound
+    def condition(self):
+        return asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.window))
+            self.in_flight += 1
+
+    async def release(self, error=None):
+        self.report(error)
+        await self._free()
+
+    async def _free(self):
+        async with self.condition:
+            self.in_flight -= 1
+            # Only wake as many waiters as there are free slots, waking all of them is quadratic for long queues
+            self.condition.notify(max(int(self.window) - self.in_flight, 0))
+
+    def report(self, error=None):
+        """
+        Adjusts the window based on the outcome of a call that wasn't traced
+        """
+        if is_rate_limited(error):
+            self.on_rate_limit(_headers(error))
+
+        elif error is None:
+            self.on_success()
+
+    def observe(self, status, headers):
+        if status == 429:
+            self.on_rate_limit(headers)
+
+        elif status < 400:
+            self.on_success(headers)
+
+    def on_success(self, headers=None):
+        self.successes += 1
+        if headers is not None and headers.get("X-RateLimit-Remaining") == "0":
+            # The bucket is exhausted, growing the window would only cause 429s
+            return
+
+        self.window = min(self.window + self.increase / self.window, self.maximum)
+
+    def on_rate_limit(self, headers=None):
+        self.rate_limits += 1
+        now = time.monotonic()
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+
+        self._last_decrease = now
+        self.window = max(self.window * self.decrease, self.minimum)
+
+        headers = headers or {}
+        if headers.get("X-RateLimit-Global") == "true":
+            self.window = self.minimum
+
+    @asynccontextmanager
+    async def permit(self):
+        await self.acquire()
+        permit = Permit(self)
+        token = current_permit.set(permit)
+        error = None
+        try:
+            yield
+
+        except BaseException as e:
+            error = e
+            raise
+
+        finally:
+            current_permit.reset(token)
+            if not permit.observed:
+                self.report(error)
+
+            await self._free()
+
+    def metrics(self):
+        return {
+            "window": round(self.window, 2),
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "rate_limits": self.rate_limits
+        }
+
+
+class Permit:
+    def __init__(self, controller):
+        self.controller = controller
+        self.observed = False
+
+
+async def _on_request_end(session, context, params):
+    permit = current_permit.get()
+    if permit is not None:
+        permit.observed = True
+        permit.controller.observe(params.response.status, params.response.headers)
+
+
+def trace(session):
+    """
+    Reports the status and headers of every response to the controller of the current permit
+
+    This also sees the 429s that the http client retries on its own and never raises.
+    aiohttp only takes trace configs when a session is created, the session of the http client already exists.
+    """
+    config = aiohttp.TraceConfig()
+    config.on_request_end.append(_on_request_end)
+    config.freeze()
+    session._trace_configs.append(config)
+
+
+class TrafficControl:
+    """
+    Keeps one controller per route class, controllers are created on first use
+    """
+    def __init__(self, limits=None):
+        self.limits = {**ROUTE_LIMITS, **(limits or {})}
+        self.controllers = {}
+
+    def controller(self, route_class):
+        controller = self.controllers.get(route_class)
+        if controller is None:
+            initial, minimum, maximum = self.limits.get(route_class, DEFAULT_LIMITS)
+            controller = self.controllers[route_class] = AIMDController(initial, minimum, maximum)
+
+        return controller
+
+    def permit(self, route_class):
+        return self.controller(route_class).permit()
+
+    def metrics(self):
+        return {route_class: controller.metrics() for route_class, controller in self.controllers.items()}
+
+
+class Lane:
+    def __init__(self, name):
+        self.name = name
+        self.waiters = deque()
+        self.granted = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+    def record(self, waited):
+        self.granted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+    def metrics(self):
+        return {
+            "depth": len(self.waiters),
+            "granted": self.granted,
+            "avg_wait": round(self.wait_total / self.granted, 3) if self.granted else 0,
+            "max_wait": round(self.wait_max, 3)
+        }
+
+
+class LaneScheduler:
+    """
+    Limits the number of concurrent HTTP requests and hands out free slots by priority
+
+    Interactive requests go first, but every n-th slot goes to the bulk lane if it's waiting,
+    so loaders and interval backups always keep a minimum share.
+    """
+    def __init__(self, concurrency=50, bulk_share=0.2):
+        self.concurrency = concurrency
+        self.lanes = {
+            "interactive": Lane("interactive"),
+            "bulk": Lane("bulk")
+        }
+        self.in_flight = 0
+        self._bulk_every = max(round(1 / bulk_share), 1)
+        self._since_bulk = 0
+
+    def _next_lane(self):
+        interactive, bulk = self.lanes["interactive"], self.lanes["bulk"]
+        if bulk.waiters and (not interactive.waiters or self._since_bulk >= self._bulk_every - 1):
+            return bulk
+
+        if interactive.waiters:
+            return interactive
+
+        return None
+
+    def _wake(self):
+        while self.in_flight < self.concurrency:
+            lane = self._next_lane()
+            if lane is None:
+                return
+
+            waiter = lane.waiters.popleft()
+            if waiter.done():
+                # Cancelled while waiting
+                continue
+
+            waiter.set_result(None)
+            self.in_flight += 1
+            self._since_bulk = 0 if lane.name == "bulk" else self._since_bulk + 1
+
+    async def acquire(self, lane_name):
+        lane = self.lanes[lane_name]
+        start = time.monotonic()
+        if self.in_flight < self.concurrency and not any(other.waiters for other in self.lanes.values()):
+            self.in_flight += 1
+
+        else:
+            waiter = asyncio.get_event_loop().create_future()
+            lane.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was already handed to us
+                    self.release()
+
+                elif waiter in lane.waiters:
+                    lane.waiters.remove(waiter)
+
+                raise
+
+        lane.record(time.monotonic() - start)
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def wrap(self, request):
+        async def _request(*args, **kwargs):
+            await self.acquire(current_lane.get())
+            try:
+                return await request(*args, **kwargs)
+            finally:
+                self.release()
+
+        return _request
+
+    def metrics(self):
+        return {name: lane.metrics() for name, lane in self.lanes.items()}
@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from pymongo import errors as mongoerrors
+
+import utils
+import columnar
+
+MERGE_RETRIES = 5
+
+
+def pack_pairs(translations):
+    """
+    Packs source and target ids as consecutive int64 values
+    """
+    return columnar.pack_ids(i for pair in sorted(translations.items()) for i in pair)
+
+
+def unpack_pairs(data):
+    ids = columnar.unpack_ids(data)
+    return dict(zip(ids[::2], ids[1::2]))
+
+
+def decode(translator):
+    if "pairs" in translator:
+        return unpack_pairs(translator["pairs"])
+
+    # Translators from before the binary format stored one field per id
+    return {
+        utils.snowflake(source): utils.snowflake(target)
+        for source, target in translator.get("ids", {}).items()
+    }
+
+
+class IdTranslators:
+    """
+    Keeps the id translations between source and target guilds
+
+    Translations are merged with a compare-and-swap on the version field, so concurrent loads can't overwrite
+    each other. The most recently used translators are kept in memory, other workers might have changed them
+    in the meantime, so only the version is read before a cached translator is used.
+    """
+    def __init__(self, db, cache_size=1000):
+        self.db = db
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+    def _remember(self, key, version, translations):
+        self._cache[key] = (version, translations)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _fetch(self, key):
+        source_id, target_id = key
+        translator = await self.db.id_translators.find_one({
+            "source_id": utils.snowflake_filter(source_id),
+            "target_id": utils.snowflake_filter(target_id)
+        }, projection={"loaders": False})
+        if translator is None:
+            result = (0, {})
+
+        else:
+            result = (translator.get("version", 0), decode(translator))
+
+        self._remember(key, *result)
+        return result
+
+    async def _stored_version(self, key):
+        source_id, target_id = key
+        translator = await self.db.id_translators.find_one({
+            "source_id": utils.snowflake_filter(source_id),
+            "target_id": utils.snowflake_filter(target_id)
+        }, projection={"_id": False, "version": True})
+        if translator is None:
+            return 0
+
+        return translator.get("version", 0)
+
+    async def _get(self, key, validate=False):
+        cached = self._cache.get(key)
+        if cached is not None:
+            if validate and await self._stored_version(key) != cached[0]:
+                return await self._fetch(key)
+
+            self._cache.move_to_end(key)
+            return cached
+
+        return await self._fetch(key)
+
+    async def get(self, source_id, target_id):
+        _, translations = await self._get((utils.snowflake(source_id), utils.snowflake(target_id)), validate=True)
+        return dict(translations)
+
+    async def merge(self, source_id, target_id, translations, loader_id=None):
+        key = (utils.snowflake(source_id), utils.snowflake(target_id))
+        translations = {utils.snowflake(s): utils.snowflake(t) for s, t in translations.items()}
+
+        version, existing = await self._get(key)
+        for _ in range(MERGE_RETRIES):
+            merged = {**existing, **translations}
+            update = {
+                "$set": {
+                    "source_id": key[0],
+                    "target_id": key[1],
+                    "pairs": pack_pairs(merged),
+                    "version": version + 1
+                },
+                "$unset": {"ids": ""}
+            }
+            if loader_id is not None:
+                update["$addToSet"] = {"loaders": utils.snowflake(loader_id)}
+
+            filter = {
+                "source_id": utils.snowflake_filter(key[0]),
+                "target_id": utils.snowflake_filter(key[1]),
+                "version": version if version > 0 else {"$exists": False}
+            }
+            try:
+                result = await self.db.id_translators.update_one(filter, update, upsert=version == 0)
+            except mongoerrors.DuplicateKeyError:
+                # Another worker created the translator in the meantime
+                result = None
+
+            if result is not None and (result.matched_count > 0 or result.upserted_id is not None):
+                self._remember(key, version + 1, merged)
+                return merged
+
+            version, existing = await self._fetch(key)
+
+        raise RuntimeError(f"Failed to merge id translator {key[0]} -> {key[1]}")
@@ -1,40 +1,190 @@
-import random
+import os
+import socket
+import zlib
 from datetime import datetime, timedelta
 import xenon_worker as wkr
 from enum import IntEnum
 
 
 base36 = '0123456789abcdefghijklmnopqrstuvwxyz'
+_base36_pairs = [a + b for a in base36 for b in base36]
 
 
 def base36_dumps(number: int):
     if number < 0:
         return '-' + base36_dumps(-number)
 
-    value = ''
+    if number < len(base36):
+        return base36[number]
 
-    while number != 0:
-        number, index = divmod(number, len(base36))
-        value = base36[index] + value
+    # Two digits per division
+    value = ''
+    while number >= len(_base36_pairs):
+        number, index = divmod(number, len(_base36_pairs))
+        value = _base36_pairs[index] + value
 
-    return value or '0'
+    return _base36_pairs[number].lstrip('0') + value
 
 
 def base36_loads(value):
     return int(value, len(base36))
 
 
+# Layout of the ids: 1 marker bit, 40 bits milliseconds since ID_EPOCH, 10 bits worker id, 12 bits sequence
+# Older ids consist of the unix timestamp in milliseconds and 8 random bits and never have the marker bit set
+ID_EPOCH = 1577836800000  # 2020-01-01
+ID_MARKER = 1 << 62
+TIMESTAMP_SHIFT = 22
+TIMESTAMP_MASK = (1 << 40) - 1
+WORKER_SHIFT = 12
+WORKER_MASK = (1 << 10) - 1
+SEQUENCE_MASK = (1 << 12) - 1
+
+
+def default_worker_id():
+    """
+    The worker id of this process, run.py assigns a distinct one to every worker process
+    """
+    worker_id = os.environ.get("WORKER_ID")
+    if worker_id is None:
+        # Only good enough for development, hashes of different processes can collide
+        print("WORKER_ID is not set, falling back to a hashed worker id")
+        return zlib.crc32(f"{socket.gethostname()}:{os.getpid()}".encode()) & WORKER_MASK
+
+    worker_id = int(worker_id)
+    if not 0 <= worker_id <= WORKER_MASK:
+        raise ValueError(f"WORKER_ID must be between 0 and {WORKER_MASK}")
+
+    return worker_id
+
+
+class IdGenerator:
+    """
+    Generates ids that are unique as long as every process uses a different worker id
+
+    There is no locking involved, this must only be used from one thread (the event loop).
+    When the sequence of a millisecond is exhausted, the generator moves on to the next millisecond
+    instead of waiting, ids stay monotonic even if the clock goes backwards.
+    """
+    def __init__(self, worker_id=None):
+        self.worker_id = (default_worker_id() if worker_id is None else worker_id) & WORKER_MASK
+        self._last = 0
+        self._sequence = 0
+
+    def generate(self, count=1):
+        result = []
+        while len(result) < count:
+            now = int(datetime.utcnow().timestamp() * 1000) - ID_EPOCH
+            if now > self._last:
+                self._last = now
+                self._sequence = 0
+
+            elif self._sequence > SEQUENCE_MASK:
+                self._last += 1
+                self._sequence = 0
+
+            take = min(count - len(result), SEQUENCE_MASK + 1 - self._sequence)
+            base = ID_MARKER | (self._last << TIMESTAMP_SHIFT) | (self.worker_id << WORKER_SHIFT)
+            result.extend(range(base + self._sequence, base + self._sequence + take))
+            self._sequence += take
+
+        return result
+
+
+_generator = None
+_generator_pid = None
+
+
+def _get_generator():
+    global _generator, _generator_pid
+    # Forked processes need their own worker id
+    if _generator is None or _generator_pid != os.getpid():
+        _generator = IdGenerator()
+        _generator_pid = os.getpid()
+
+    return _generator
+
+
+def unique_ids(count):
+    """
+    Generates multiple unique ids at once
+    """
+    return [base36_dumps(uid) for uid in _get_generator().generate(count)]
+
+
 def unique_id():
     """
-    Generates a unique id consisting of the the unix timestamp and 8 random bits
+    Generates a unique id consisting of a timestamp, the worker id and a sequence number
     """
-    unix_t = int(datetime.utcnow().timestamp() * 1000)
-    result = (unix_t << 8) | random.getrandbits(8)
-    return base36_dumps(result)
+    return unique_ids(1)[0]
 
 
 def timestamp_from_id(uid):
-    return datetime.utcfromtimestamp((base36_loads(uid) >> 8) / 1000)
+    value = base36_loads(uid)
+    if value >> 62 == 1:
+        milliseconds = ((value >> TIMESTAMP_SHIFT) & TIMESTAMP_MASK) + ID_EPOCH
+
+    else:
+        milliseconds = value >> 8
+
+    return datetime.utcfromtimestamp(milliseconds / 1000)
+
+
+def snowflake(value):
+    """
+    Converts a snowflake to the int64 representation that is used in the database
+    """
+    if value is None or isinstance(value, int):
+        return value
+
+    return int(value)
+
+
+def snowflake_filter(value):
+    """
+    Matches the int64 and the legacy string representation of a snowflake, both are exact index lookups
+    """
+    value = snowflake(value)
+    return {"$in": [value, str(value)]}
+
+
+GUILD_ID_FIELDS = (
+    "id", "owner_id", "afk_channel_id", "system_channel_id", "rules_channel_id",
+    "public_updates_channel_id", "widget_channel_id"
+)
+
+
+def normalize_guild_ids(data):
+    """
+    Converts all snowflakes of backup data to int64 in place
+    """
+    for key in GUILD_ID_FIELDS:
+        if data.get(key) is not None:
+            data[key] = snowflake(data[key])
+
+    for role in data.get("roles", []):
+        normalize_role_ids(role)
+
+    for channel in data.get("channels", []):
+        normalize_channel_ids(channel)
+
+    return data
+
+
+def normalize_role_ids(role):
+    role["id"] = snowflake(role["id"])
+    return role
+
+
+def normalize_channel_ids(channel):
+    channel["id"] = snowflake(channel["id"])
+    if channel.get("parent_id") is not None:
+        channel["parent_id"] = snowflake(channel["parent_id"])
+
+    for overwrite in channel.get("permission_overwrites", []):
+        overwrite["id"] = snowflake(overwrite["id"])
+
+    return channel
 
 
 def datetime_to_string(dt: datetime):
@@ -76,6 +226,36 @@ class IterWaitFor:
         return await self.client.wait_for(*self.args, **self.kwargs)
 
 
+class loop_bound:
+    """
+    A property that creates its value on first access
+
+    asyncio primitives must be created inside of the running loop, not when the owning object is constructed.
+    The value is stored in the attribute with the same name prefixed with an underscore.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.attribute = "_" + factory.__name__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        value = getattr(instance, self.attribute, None)
+        if value is None:
+            value = self.factory(instance)
+            setattr(instance, self.attribute, value)
+
+        return value
+
+
+async def acquire_lease(redis, name, seconds):
+    """
+    Returns True for only one worker until the lease expires, used to run periodic tasks on a single worker
+    """
+    return bool(await redis.set(f"leases:{name}", os.getpid(), expire=seconds, exist=redis.SET_IF_NOT_EXIST))
+
+
 def channel_tree(channels):
     text = []
     voice = []